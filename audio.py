@@ -1,19 +1,39 @@
 from midi import MidiController
+from scheduler import MidiScheduler, BeatClock, LOOKAHEAD_STEPS, STEPS_PER_YEAR
 import numpy as np
-import pandas as pd
 from random import randrange, randint, choice
 from time import time
+from metrics import histogram
+from sensor_state import SensorState
 
-import multiprocessing as mp
 
 AMBIENT_CHANNEL = 0
 MUSIC_CHANNEL = 1
 RETURN_CHANNEL = 2
 
+MINUTES_PER_DAY = 1440
+
+# First control/note of each sample's bank, and the sample that stops a bank
+SAMPLE_BANKS = list(range(0, 71, 10))
+STOP_SAMPLE = 8
+
 class Audio:
-    def __init__(self, df):
-        self.controller = MidiController()
-        self.df = df
+    def __init__(self, timeline, clock=None, lookahead=LOOKAHEAD_STEPS, metrics=None):
+        self.controller = MidiController(metrics)
+        self.timeline = timeline
+
+        # Step events are worked out `lookahead` steps early and sent by the
+        # scheduler at the predicted time of their step. Predictions come from the
+        # Listener's shared clock if we have it, otherwise from the steps we see.
+        self.lookahead = lookahead
+        self.clock = clock if clock is not None else BeatClock()
+        self.scheduler = MidiScheduler(metrics=metrics)
+
+        # Set from the scheduler thread once new music settings have gone out,
+        # so the step loop pushes every sensor's volume again on top of them
+        self.sensors_stale = False
+
+        self.step_lag = histogram(metrics, 'audio.step_lag')
 
     def generate_samples(self, sensor_flags):
         # Create array to hold data
@@ -45,87 +65,116 @@ class Audio:
         # We start at midday, then make changes every 32 bars from (roughly) 7pm to ???am
         # Subtrct four so that we trigger a sample a beat before it needs to start
         ts = [x - 4 for x in [720, 1104, 1232, 1360, 48, 176, 304, 432]]
-        cols = list(range(0, 71, 10))
-
-        # Convert array to dataframe
-        df_samples = pd.DataFrame(data=sample_values, index=ts, columns=cols)
 
         # Record the order we're activating samples in
-        self.sample_order = []
-        for _, row in df_samples.iterrows():
-            self.sample_order.append(row[row.notnull()].index[0])
+        self.sample_order = [SAMPLE_BANKS[np.flatnonzero(~np.isnan(row))[0]] for row in sample_values]
 
-        # Forward fill
-        df_samples.ffill(inplace=True)
+        # Forward fill, each change keeps the samples from the ones before it
+        for n in range(1, 8):
+            sample_values[n] = np.where(np.isnan(sample_values[n]), sample_values[n-1], sample_values[n])
 
         # Set missing values to 8 (stop command)
-        df_samples.fillna(8, inplace=True)
+        sample_values[np.isnan(sample_values)] = STOP_SAMPLE
 
         # If there are sensors the samples are always ready to be played, if activated by a sensor
         # Otherwise a "song" is built with the samples triggering in a specific order
         # We hack this by setting all values to the last row (fully built song)
         if sensor_flags:
-            df_samples.iloc[:,:] = df_samples.iloc[5,].values
+            sample_values[:] = sample_values[5]
+
+        # Another set of rows to hold the fills. These occur 16 beats before each change.
+        fill_values = sample_values.copy()
+        fill_ts = [x - 4 - 16 for x in [1104, 1232, 1360, 48, 176, 304, 432, 720]]
 
-        # Create another dataframe to hold the fills. These occur 16 beats before each change.
-        df_fills = df_samples.copy()
-        df_fills.index = [x - 4 - 16 for x in [1104, 1232, 1360, 48, 176, 304, 432, 720]]
-        
         # If there is a drum sample on the next row use a random fill value
         # Note that there is no fill added before the midday row - this is fine
-        for i in range(7):
-            index = df_fills.index[i]
-            next_index = df_fills.index[i+1]
-            for col in range(0, 20, 10):
-                if df_fills.at[next_index, col] != 8:
-                    df_fills.at[index, col] = randint(6,7)
+        for n in range(7):
+            for col in range(2):
+                if fill_values[n+1][col] != STOP_SAMPLE:
+                    fill_values[n][col] = randint(6,7)
 
-        # Add fills back to samples dataframe
-        df_samples = df_samples.append(df_fills)
-
-        # Sort on timestep
-        df_samples.sort_index(inplace=True)
+        # Changes sorted on timestep
+        changes = sorted(zip(ts + fill_ts, np.concatenate((sample_values, fill_values)).astype(int)), key=lambda x: x[0])
 
         # Duplicate last row and set to midday
-        last_row = pd.DataFrame(df_samples[-1:].values, index=[0], columns=df_samples.columns)
-        df_samples = df_samples.append(last_row)
+        changes.insert(0, (0, changes[-1][1]))
+
+        # Compile into samples for every minute of the day
+        samples = np.empty((MINUTES_PER_DAY, len(SAMPLE_BANKS)), dtype=np.int64)
+        for n, (t, row) in enumerate(changes):
+            t_next = changes[n+1][0] if n + 1 < len(changes) else MINUTES_PER_DAY
+            samples[t:t_next] = row
 
-        # Sort again
-        df_samples.sort_index(inplace=True)
+        # Precompute the notes to send at each minute, relative to the minute before
+        self.note_ons = []
+        for day_idx in range(MINUTES_PER_DAY):
+            changed = np.flatnonzero(samples[day_idx] != samples[day_idx - 1])
+            self.note_ons.append([int(SAMPLE_BANKS[b] + samples[day_idx][b]) for b in changed])
 
-        # Convert to int and return
-        df_samples = df_samples.astype('int')
         print('NEW SAMPLES')
-        print(df_samples)
+        print('      ' + ' '.join('%4d' % bank for bank in SAMPLE_BANKS))
+        for t, row in changes:
+            print('%-6d' % t + ' '.join('%4d' % sample for sample in row))
         print('Sample order')
         print(self.sample_order)
-        return df_samples
-    
-    def set_initial_music_settings(self):
-        # Set first two ordered music samples to all speakers
-        for sensor_id in range(2):
-            sample_bank = self.sample_order[sensor_id]
-            self.set_all_speakers(MUSIC_CHANNEL, sample_bank)
-
-        # Set the other six to go to individual speakers
-        for sensor_id in range(6):
-            sample_bank = self.sample_order[sensor_id+2]
-            self.set_solo_speaker(MUSIC_CHANNEL, sample_bank, sensor_id)
+        return samples
+
+    def notes_between(self, samples_last, samples_now):
+        # Notes for every bank whose sample differs
+        return [int(SAMPLE_BANKS[b] + samples_now[b]) for b in np.flatnonzero(samples_now != samples_last)]
+
+    def play_step(self, ambient_notes, volumes, music_notes):
+        # Everything that happens on one step, sent from the scheduler thread
+        for note in ambient_notes:
+            self.controller.play_note(AMBIENT_CHANNEL, note=note)
+
+        if volumes is not None:
+            ambient_vol, music_vol = volumes
+            with self.controller.batch():
+                for cc in range(3):
+                    self.controller.set_control(RETURN_CHANNEL, control=cc, value=ambient_vol)
+                # print("setting ambient volume to " + str(ambient_vol))
+
+                for cc in range(3, 6):
+                    self.controller.set_control(RETURN_CHANNEL, control=cc, value=music_vol)
+                # print("setting music volume to " + str(127-ambient_vol))
+
+        for note in music_notes:
+            self.controller.play_note(MUSIC_CHANNEL, note=note)
+            print("sending music note " + str(note))
+
+    def reset_music_settings(self):
+        # Sensor volumes have to follow the new settings, not come before them
+        self.set_initial_music_settings()
+        self.sensors_stale = True
 
-        # Set all other channels to off
-        for sample_bank in range(0, 71, 10):
-            if sample_bank not in self.sample_order:
-                self.set_all_off(MUSIC_CHANNEL, sample_bank)
+    def set_initial_music_settings(self):
+        with self.controller.batch():
+            # Set first two ordered music samples to all speakers
+            for sensor_id in range(2):
+                sample_bank = self.sample_order[sensor_id]
+                self.set_all_speakers(MUSIC_CHANNEL, sample_bank)
+
+            # Set the other six to go to individual speakers
+            for sensor_id in range(6):
+                sample_bank = self.sample_order[sensor_id+2]
+                self.set_solo_speaker(MUSIC_CHANNEL, sample_bank, sensor_id)
+
+            # Set all other channels to off
+            for sample_bank in range(0, 71, 10):
+                if sample_bank not in self.sample_order:
+                    self.set_all_off(MUSIC_CHANNEL, sample_bank)
 
     def set_initial_ambient_settings(self):
-        # Set seventh ambient sample to all speakers
-        sample_bank = 60
-        self.set_all_speakers(AMBIENT_CHANNEL, sample_bank)
+        with self.controller.batch():
+            # Set seventh ambient sample to all speakers
+            sample_bank = 60
+            self.set_all_speakers(AMBIENT_CHANNEL, sample_bank)
 
-        # Set the other six to go to individual speakers
-        for sensor_id in range(6):
-            sample_bank = sensor_id * 10
-            self.set_solo_speaker(AMBIENT_CHANNEL, sample_bank, sensor_id)
+            # Set the other six to go to individual speakers
+            for sensor_id in range(6):
+                sample_bank = sensor_id * 10
+                self.set_solo_speaker(AMBIENT_CHANNEL, sample_bank, sensor_id)
 
     def set_all_speakers(self, channel, sample_bank):
         if channel == AMBIENT_CHANNEL:
@@ -140,13 +189,14 @@ class Audio:
             raise Exception("Channel not recognized")
 
         print(channel_name + ' Bank ' + str(sample_bank) + ' to all speakers')
-        # Set channel volume and pan to center
-        for control in range(2):
-            self.controller.set_control(channel, control=sample_bank+control, value=63)
-        # Set send volumes
-        for send in range(3):
-            self.controller.set_control(channel, control=sample_bank+2+send, value=a_b_c_vol)
-            self.controller.set_control(channel, control=sample_bank+5+send, value=d_e_f_vol)
+        with self.controller.batch():
+            # Set channel volume and pan to center
+            for control in range(2):
+                self.controller.set_control(channel, control=sample_bank+control, value=63)
+            # Set send volumes
+            for send in range(3):
+                self.controller.set_control(channel, control=sample_bank+2+send, value=a_b_c_vol)
+                self.controller.set_control(channel, control=sample_bank+5+send, value=d_e_f_vol)
 
     def set_solo_speaker(self, channel, sample_bank, id):
 
@@ -164,52 +214,54 @@ class Audio:
         else:
             pan_value = 127
 
-        # Set pan and volume
-        self.controller.set_control(channel=channel, control=sample_bank+1, value=pan_value)
-        self.controller.set_control(channel=channel, control=sample_bank, value=95)
-
-        # Set to off if ambient and we have sensors, on otherwise
-        if channel == AMBIENT_CHANNEL:
-            print('Ambient Bank ' + str(sample_bank) + ' to solo speaker')
-            # Set send to A or B
-            if id in (0, 1):
-                send_cc = 0 # Send A
-            elif id in (2, 3):
-                send_cc = 1 # Send B
+        with self.controller.batch():
+            # Set pan and volume
+            self.controller.set_control(channel=channel, control=sample_bank+1, value=pan_value)
+            self.controller.set_control(channel=channel, control=sample_bank, value=95)
+
+            # Set to off if ambient and we have sensors, on otherwise
+            if channel == AMBIENT_CHANNEL:
+                print('Ambient Bank ' + str(sample_bank) + ' to solo speaker')
+                # Set send to A or B
+                if id in (0, 1):
+                    send_cc = 0 # Send A
+                elif id in (2, 3):
+                    send_cc = 1 # Send B
+                else:
+                    send_cc = 2 # Send C
+
+            # Set to on if music
+            elif channel == MUSIC_CHANNEL:
+                print('Music Bank ' + str(sample_bank) + ' to solo speaker')
+                # Set send to C or D
+                if id in (0, 1):
+                    send_cc = 3 # Send D
+                elif id in (2, 3):
+                    send_cc = 4 # Send E
+                else:
+                    send_cc = 5 # Send F
             else:
-                send_cc = 2 # Send C
+                raise Exception("Channel not recognized")
 
-        # Set to on if music
-        elif channel == MUSIC_CHANNEL:
-            print('Music Bank ' + str(sample_bank) + ' to solo speaker')
-            # Set send to C or D
-            if id in (0, 1):
-                send_cc = 3 # Send D
-            elif id in (2, 3):
-                send_cc = 4 # Send E
-            else:
-                send_cc = 5 # Send F
-        else:
-            raise Exception("Channel not recognized")
-
-        for send in range(6):
-            # Set the send we want to on, set the rest to off
-            if send == send_cc:
-                self.controller.set_control(channel=channel, control=sample_bank+2+send, value=127)
-            else:
-                self.controller.set_control(channel=channel, control=sample_bank+2+send, value=0)
+            for send in range(6):
+                # Set the send we want to on, set the rest to off
+                if send == send_cc:
+                    self.controller.set_control(channel=channel, control=sample_bank+2+send, value=127)
+                else:
+                    self.controller.set_control(channel=channel, control=sample_bank+2+send, value=0)
 
     def set_all_off(self, channel, sample_bank):
         print('Channel ' + str(channel) + ' Bank ' + str(sample_bank) + ' off')
-        self.controller.set_control(channel=channel, control=sample_bank, value=0)
-        self.controller.set_control(channel=channel, control=sample_bank+1, value=63)
-        for send in range(6):
-            self.controller.set_control(channel=channel, control=sample_bank+2+send, value=0)
+        with self.controller.batch():
+            self.controller.set_control(channel=channel, control=sample_bank, value=0)
+            self.controller.set_control(channel=channel, control=sample_bank+1, value=63)
+            for send in range(6):
+                self.controller.set_control(channel=channel, control=sample_bank+2+send, value=0)
 
     def run(self, i, sensor_flags):
 
         # Populate samples
-        self.df_samples = self.generate_samples(sensor_flags)
+        self.samples = self.generate_samples(sensor_flags)
 
         # start playback
         self.controller.play_note(RETURN_CHANNEL, note=100)
@@ -221,85 +273,110 @@ class Audio:
         
         if sensor_flags is not None:
             sensor_flags_last = [-1, -1, -1, -1, -1, -1]
+            sensor_seq_last = -1
 
-        # Last samples data frame is a row with all samples set to -1
-        df_samples_last = self.df_samples.head(1).copy()
-        for col in df_samples_last.columns:
-            df_samples_last[col].values[:] = -1
+        # Last samples are all set to -1
+        samples_last = np.full(len(SAMPLE_BANKS), -1)
+        day_idx_last = -1
 
         self.set_initial_music_settings()
         self.set_initial_ambient_settings()
 
+        self.scheduler.start()
+
+        tick_count = -1
+
         while True:
-            if i.value != i_last: # timestep has changed
-                row = self.df.iloc[i.value]
+            # Block until the clock publishes a new step
+            tick = i.wait(tick_count)
+            tick_count = tick.count
+            self.step_lag.observe(time() - tick.timestamp)
+
+            if tick.missed:
+                print('WARNING: Audio missed ' + str(tick.missed) + ' steps')
+
+            if tick.index != i_last: # timestep has changed
+                self.clock.sync(tick.index, tick.timestamp)
 
-                ambient_vol = int(row['Direct Beam'] * 95)
+                # The step we're queueing events for, and when it will happen
+                ahead_idx = (tick.index + self.lookahead) % STEPS_PER_YEAR
+                step_time = self.clock.time_of(ahead_idx)
 
+                ambient_vol = int(self.timeline.ambient_vol[ahead_idx])
+                music_vol = int(self.timeline.music_vol[ahead_idx])
+
+                # Every sensor in one read, and only looked at if one has changed
                 if sensor_flags is not None:
-                    # print('sensor_flags: ' + str([s.value for s in sensor_flags]))
-                    # print('sensor_flags_last: ' + str(sensor_flags_last))
-                    # For every sensor, 
-                    for sensor_id in range(6):
-                        # If the value has changed
-                        # print('sensor_flags[' + str(sensor_id) + '].value: ' + str(sensor_flags[sensor_id].value))
-                        # print('sensor_flags_last[' + str(sensor_id) + ']: ' + str(sensor_flags_last[sensor_id]))
-                        if sensor_flags[sensor_id].value != sensor_flags_last[sensor_id]:
-
-                            print('Processing sensor ' + str(sensor_id+1) + ' (' + str(sensor_flags[sensor_id].value) +')')
+                    if self.sensors_stale:
+                        self.sensors_stale = False
+                        sensor_flags_last = [-1, -1, -1, -1, -1, -1]
+                        sensor_seq_last = -1
+                    sensors_now = sensor_flags.read()
+                    if sensors_now.seq != sensor_seq_last:
+                        # print('sensor_flags: ' + str(sensors_now.flags))
+                        # print('sensor_flags_last: ' + str(sensor_flags_last))
+                        # For every sensor, 
+                        for sensor_id in range(6):
+                            on = sensors_now.flags[sensor_id]
+
+                            # If the value has changed
+                            if on != sensor_flags_last[sensor_id]:
+
+                                print('Processing sensor ' + str(sensor_id+1) + ' (' + str(int(on)) +')')
                             
-                            # Set music volume on
-                            sample_bank = self.sample_order[sensor_id+2]
-                            print('Music Bank ' + str(sample_bank) + ' (' + str(sensor_flags[sensor_id].value) +')')
-                            self.controller.set_control(MUSIC_CHANNEL, control=sample_bank, value=int(sensor_flags[sensor_id].value)*95)
-
-                            # Set ambient volume on
-                            # (Ambient banks are constant, no need to lookup)
-                            sample_bank = sensor_id * 10
-                            print('Ambient Bank ' + str(sample_bank) + ' (' + str(sensor_flags[sensor_id].value) +')')
-                            self.controller.set_control(AMBIENT_CHANNEL, control=sample_bank, value=int(sensor_flags[sensor_id].value)*95)
+                                # Set music volume on
+                                sample_bank = self.sample_order[sensor_id+2]
+                                print('Music Bank ' + str(sample_bank) + ' (' + str(int(on)) +')')
+                                self.controller.set_control(MUSIC_CHANNEL, control=sample_bank, value=int(on)*95)
+
+                                # Set ambient volume on
+                                # (Ambient banks are constant, no need to lookup)
+                                sample_bank = sensor_id * 10
+                                print('Ambient Bank ' + str(sample_bank) + ' (' + str(int(on)) +')')
+                                self.controller.set_control(AMBIENT_CHANNEL, control=sample_bank, value=int(on)*95)
                         
-                            # Update last sensor flags
-                            sensor_flags_last[sensor_id] = sensor_flags[sensor_id].value
+                                # Update last sensor flags
+                                sensor_flags_last[sensor_id] = on
+
+                        sensor_seq_last = sensors_now.seq
 
+                ambient_notes = []
                 if ambient != ambient_last:
-                    for sample_bank in range(0, 70, 10):
-                        self.controller.play_note(AMBIENT_CHANNEL, note=sample_bank+ambient)
+                    ambient_notes = [sample_bank+ambient for sample_bank in range(0, 70, 10)]
                     ambient_last = ambient
 
+                volumes = None
                 if ambient_vol != ambient_vol_last:
-                    for cc in range(3):
-                        self.controller.set_control(RETURN_CHANNEL, control=cc, value=ambient_vol)
-                    # print("setting ambient volume to " + str(ambient_vol))
-
-                    for cc in range(3, 6):
-                        self.controller.set_control(RETURN_CHANNEL, control=cc, value=(95-ambient_vol))
-                    # print("setting music volume to " + str(127-ambient_vol))
+                    volumes = (ambient_vol, music_vol)
 
                 # Get index for hour of day
-                day_idx = i.value % 1440
+                day_idx = ahead_idx % 1440
 
                 # Get current sample status
-                df_samples_now = self.df_samples[self.df_samples.index <= day_idx].tail(1)
+                samples_now = self.samples[day_idx]
+
+                # Activate new samples. Stepping on by a minute uses the precomputed
+                # changes, anything else (start up, skipped steps, new samples) is diffed.
+                if day_idx_last >= 0 and day_idx == (day_idx_last + 1) % MINUTES_PER_DAY:
+                    notes = self.note_ons[day_idx]
+                else:
+                    notes = self.notes_between(samples_last, samples_now)
 
-                # Activate new samples
-                for sample_bank, sample in df_samples_now.items():
-                    note = sample_bank + sample.values[0]
-                    last_note = sample_bank + df_samples_last[sample_bank].values[0]
-                    if note != last_note:
-                        self.controller.play_note(MUSIC_CHANNEL, note=note)
-                        print("sending music note " + str(note))
+                if ambient_notes or volumes is not None or notes:
+                    self.scheduler.at(step_time, self.play_step, ambient_notes, volumes, notes)
+
+                samples_last = samples_now
+                day_idx_last = day_idx
 
                 # If we're just before midday, regenerate music samples
                 if day_idx == (12*60 - 4 - 4):
-                    self.df_samples = self.generate_samples(sensor_flags)
+                    self.samples = self.generate_samples(sensor_flags)
 
-                    # Reset sensor flags
-                    if sensor_flags is not None:
-                        sensor_flags_last = [-1, -1, -1, -1, -1, -1]
+                    # Next step is compared against the old samples
+                    day_idx_last = -1
 
-                    # Reset music settings for new samples
-                    self.set_initial_music_settings()
+                    # Reset music settings for new samples, then sensor volumes
+                    self.scheduler.at(step_time, self.reset_music_settings)
 
 
                 # If we're just before midnight, pick new ambient sample
@@ -307,20 +384,17 @@ class Audio:
                     ambient = choice([i for i in range(0,5) if i != ambient])
 
 
-                i_last = i.value
+                # Report event timing once a day
+                if day_idx == 0:
+                    print('MIDI timing: ' + self.scheduler.stats.report())
+                    self.scheduler.stats.reset()
+
+                i_last = tick.index
                 ambient_vol_last = ambient_vol
-                df_samples_last = df_samples_now.copy()
 
 if __name__ == "__main__":
 
-    s1 = mp.Value('b', False)
-    s2 = mp.Value('b', False)
-    s3 = mp.Value('b', False)
-    s4 = mp.Value('b', False)
-    s5 = mp.Value('b', False)
-    s6 = mp.Value('b', False)
-
-    sensor_flags = [s1, s2, s3, s4, s5, s6]
+    sensor_flags = SensorState()
 
     audio = Audio(None)
     audio.generate_samples(sensor_flags)
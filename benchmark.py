@@ -0,0 +1,291 @@
+import sys
+import random
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+def timed(fn, *args, repeat=3):
+    # Best of a few runs, returns (seconds, result of last run)
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def report(name, seconds, baseline=None):
+    line = '%-28s %10.2f ms' % (name, seconds * 1000)
+    if baseline:
+        line = line + '   (%.1fx)' % (baseline / seconds)
+    print(line)
+
+### DATA ###
+
+def legacy_build_data(path='irradiance.csv'):
+    # The original merge/concat based build, kept here for comparison only
+    df = pd.read_csv(path)
+
+    df_mins = pd.DataFrame(data={'mins': range(0, 60)})
+
+    df['key'] = 0
+    df_mins['key'] = 0
+
+    df = df.merge(df_mins, on='key', how='outer')
+
+    df['Timestamp'] = pd.to_datetime(df['Timestamp']) + pd.to_timedelta(df['mins'], unit='m')
+
+    df.drop(columns=['key', 'mins'], inplace=True)
+
+    df.loc[:, df.columns!='Timestamp'] = df.loc[:, df.columns!='Timestamp'][::-1].rolling(60, min_periods=1).mean()[::-1]
+
+    df.loc[:, df.columns!='Timestamp'] = df.loc[:, df.columns!='Timestamp'].apply(lambda x: 1.25 * (x - x.min())/(x.max() - x.min())).clip(upper=1)
+
+    s = pd.Series(dtype='float')
+
+    while len(s) < len(df):
+        s = pd.concat([s, np.sin(pd.Series(range(0, 360, random.randint(1, 5))) * np.pi / 180)])
+
+    df = df.merge(s.rename('Brightness', inplace=True).reset_index(), how='left', left_index=True, right_index=True)
+
+    return df
+
+def bench_data():
+    from data import build_data
+
+    legacy_time, legacy = timed(legacy_build_data)
+    new_time, new = timed(build_data)
+
+    report('legacy build_data', legacy_time)
+    report('build_data', new_time, legacy_time)
+
+    # Brightness is random so only the deterministic columns are compared
+    assert len(legacy) == len(new)
+    assert (legacy['Timestamp'].values == new['Timestamp'].values).all()
+    for col in ['Direct Beam', 'Direct Hz', 'Global Hz', 'Dif Hz']:
+        assert np.allclose(legacy[col].values, new[col].values, equal_nan=True), col
+    assert new['Brightness'].between(-1, 1).all()
+    print('outputs match')
+
+### VIDEO ###
+
+def test_frame(width=800, height=600):
+    # Smooth gradients with some noise, roughly like video
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.dstack([x * 255 / width, y * 255 / height, (x + y) * 255 / (width + height)])
+    frame = frame + rng.normal(0, 8, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def legacy_warp_image(frame, n, num_frames):
+    import cv2
+    h, w = frame.shape[:2]
+    wave_x = 2*w
+    wave_y = h
+    amount_x = 10
+    amount_y = 5
+    x = np.arange(w, dtype=np.float32)
+    y = np.arange(h, dtype=np.float32)
+    phase_x = n*360/num_frames
+    phase_y = phase_x
+    x_sin = amount_x * np.sin(2 * np.pi * (x/wave_x + phase_x/360)) + x
+    map_x = np.tile(x_sin, (h,1))
+    y_sin = amount_y * np.sin(2 * np.pi * (y/wave_y + phase_y/360)) + y
+    map_y = np.tile(y_sin, (w,1)).transpose()
+    return cv2.remap(frame.copy(), map_x, map_y, cv2.INTER_CUBIC, borderMode = cv2.BORDER_CONSTANT, borderValue=(0,0,0))
+
+def bench_warp(frames=200, num_frames=75):
+    from effects import WarpMaps
+
+    frame = test_frame()
+    warp_maps = WarpMaps()
+    dst = np.empty_like(frame)
+
+    def run_legacy():
+        for n in range(frames):
+            legacy_warp_image(frame, n, num_frames)
+
+    def run_cached():
+        for n in range(frames):
+            warp_maps.warp(frame, n, num_frames, dst=dst)
+
+    legacy_time, _ = timed(run_legacy)
+    cached_time, _ = timed(run_cached)
+
+    report('legacy warp (per frame)', legacy_time / frames)
+    report('cached warp (per frame)', cached_time / frames, legacy_time / frames)
+
+    # Fixed point maps round sub pixel positions to 1/32 of a pixel
+    diff = np.abs(legacy_warp_image(frame, 7, num_frames).astype(int) - warp_maps.warp(frame, 7, num_frames).astype(int))
+    print('max difference %d, mean %.3f' % (diff.max(), diff.mean()))
+
+def legacy_colour(frame, reduction):
+    # Video.change_brightness then the BGR to RGB swap
+    import cv2
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    h, s, v = cv2.split(hsv)
+    v = cv2.add(v, -reduction)
+    v[v > 255] = 255
+    v[v < 0] = 0
+    final_hsv = cv2.merge((h, s, v))
+    frame = cv2.cvtColor(final_hsv, cv2.COLOR_HSV2BGR)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+def bench_colour(frames=200, reductions=(0, 40, 100, 180)):
+    from effects import ColourStage
+
+    frame = test_frame()
+    h, w = frame.shape[:2]
+    colour = ColourStage(w, h)
+    dst = np.empty_like(frame)
+
+    def run_legacy():
+        for n in range(frames):
+            legacy_colour(frame, reductions[n % len(reductions)])
+
+    def run_fused():
+        for n in range(frames):
+            colour.apply(frame, reductions[n % len(reductions)], dst=dst)
+
+    legacy_time, _ = timed(run_legacy)
+    fused_time, _ = timed(run_fused)
+
+    report('legacy colour (per frame)', legacy_time / frames)
+    report('fused colour (per frame)', fused_time / frames, legacy_time / frames)
+
+    # HSV quantises hue and saturation so the old path is off by a little too
+    for reduction in reductions:
+        diff = np.abs(legacy_colour(frame, reduction).astype(int) - colour.apply(frame, reduction).astype(int))
+        print('reduction %3d: max difference %d, mean %.3f' % (reduction, diff.max(), diff.mean()))
+        assert diff.max() <= 8 and diff.mean() < 1
+
+class HersheyText:
+    # Stands in for cv2.freetype where opencv was built without it
+    def putText(self, img, text, org, fontHeight, color, thickness, line_type, bottomLeftOrigin):
+        import cv2
+        cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, fontHeight / 30, color, max(thickness, 1) * fontHeight // 30, line_type)
+
+def text_renderer():
+    import cv2
+    try:
+        ft = cv2.freetype.createFreeType2()
+        ft.loadFontData(fontFileName='Fondamento-Regular.ttf', id=0)
+        return ft
+    except AttributeError:
+        print('no cv2.freetype, using Hershey fonts')
+        return HersheyText()
+
+def bench_text(frames=200):
+    import cv2
+    from effects import TextOverlay
+
+    frame = test_frame()
+    h, w = frame.shape[:2]
+    ft = text_renderer()
+    overlay = TextOverlay(ft, w, h)
+    texts = [('12:45', (135, 300), 150), ('pm', (500, 300), 150), ('Fast', (50, 50), 25)]
+
+    def draw_legacy(img):
+        for text, org, font_height in texts:
+            ft.putText(img=img, text=text, org=org, fontHeight=font_height, color=(255, 255, 255),
+                       thickness=-1, line_type=cv2.LINE_AA, bottomLeftOrigin=True)
+        return img
+
+    def draw_overlay(img):
+        for name, (text, org, font_height) in zip(['time', 'am_pm', 'speed'], texts):
+            overlay.set(name, text, org, font_height)
+        return overlay.blend(img)
+
+    # Text is drawn in place, so every run starts from clean copies
+    buffers = [frame.copy() for _ in range(frames)]
+
+    def run(draw):
+        for img in buffers:
+            np.copyto(img, frame)
+            draw(img)
+
+    legacy_time, _ = timed(run, draw_legacy)
+    overlay_time, _ = timed(run, draw_overlay)
+
+    report('legacy text (per frame)', legacy_time / frames)
+    report('cached overlay (per frame)', overlay_time / frames, legacy_time / frames)
+
+    diff = np.abs(draw_legacy(frame.copy()).astype(int) - draw_overlay(frame.copy()).astype(int))
+    print('max difference %d, mean %.3f' % (diff.max(), diff.mean()))
+
+### DEVICES ###
+
+class CountingBackend:
+    # Counts the messages each bulb receives, directly or through the group
+    def __init__(self, names, group):
+        self.names = names
+        self.group = group
+        self.updates = {name: 0 for name in names}
+
+    def send(self, name, payload):
+        for target in (self.names if name == self.group else [name]):
+            self.updates[target] = self.updates[target] + 1
+
+def drive_devices(devices, timeline, start, sensors, steps, step_time):
+    # Steps go by every step_time, with Devices.run's retries in between.
+    # Returns the longest any device waited to catch up, in seconds.
+    from time import sleep, monotonic
+    worst = 0
+    for n in range(steps):
+        step_end = monotonic() + step_time
+        devices.set_step(start + n, sensors)
+        while True:
+            done = devices.flush()
+            now = monotonic()
+            stale = [now - since for since in devices.states.stale_since.values() if since is not None]
+            worst = max([worst] + stale)
+            if now >= step_end:
+                break
+            sleep(step_end - now if done else min(max(devices.limiter.wait_time(), 0.005), step_end - now))
+    return worst
+
+def bench_devices(steps=100, step_time=0.15, max_lag_steps=2):
+    # Every bulb has to keep up with the timeline whatever the sensors are
+    # doing, never more than max_lag_steps behind, at the default message budget
+    from data import load_data
+    from timeline import build_timeline
+    from devices import Devices, BULB_GROUP, N_BULBS
+
+    timeline = build_timeline(load_data(cached=True))
+
+    # 07:00 half way through the year, when brightness changes every step
+    start = (len(timeline.brightness) // 2) // 1440 * 1440 + 7 * 60
+
+    for pattern in ['111111', '110111', '101010']:
+        sensors = tuple(c == '1' for c in pattern)
+        backend = CountingBackend(['Bulb ' + str(s+1) for s in range(N_BULBS)], BULB_GROUP)
+        devices = Devices(timeline, backend=backend)
+        worst = drive_devices(devices, timeline, start, sensors, steps, step_time)
+
+        updates = ' '.join('%3d' % backend.updates[name] for name in devices.bulb_names)
+        print('sensors %s   updates per bulb %s   worst lag %.2f s' % (pattern, updates, worst))
+        assert worst <= max_lag_steps * step_time, 'a bulb fell %.2f s behind with sensors %s' % (worst, pattern)
+    print('every bulb kept up')
+
+### SYSTEM ###
+
+def bench_system(seconds=10):
+    # End to end with fake MIDI and Zigbee, see simulate.py.
+    # Listener CPU includes the synthetic MIDI clock driving it.
+    from simulate import run_simulation, print_report
+    print_report(run_simulation(seconds=seconds))
+
+BENCHMARKS = {
+    'data': bench_data,
+    'warp': bench_warp,
+    'colour': bench_colour,
+    'text': bench_text,
+    'devices': bench_devices,
+    'system': bench_system,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('### ' + name.upper() + ' ###')
+        BENCHMARKS[name]()
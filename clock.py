@@ -0,0 +1,133 @@
+import math
+import multiprocessing as mp
+from collections import namedtuple
+from time import time
+
+# MIDI clock runs at 24 ticks per quarter note, and we step every 6 ticks
+PPQN = 24
+TICKS_PER_STEP = 6
+STEPS_PER_YEAR = 525600
+
+# A consistent snapshot of the clock
+# index: step index the clock is on
+# step_time: filtered time that step started (as from time.time())
+# period: seconds per step
+# bpm: tempo
+# tick: MIDI clock tick within the beat (0-23) the step started on
+ClockState = namedtuple('ClockState', ['index', 'step_time', 'period', 'bpm', 'tick'])
+
+class TempoTracker:
+    # Second order delay locked loop over every clock tick. Jitter in when
+    # ticks are seen is filtered out of both the tick times and the period.
+    def __init__(self, bpm=100, bandwidth=0.5):
+        self.nominal_period = 60 / bpm / PPQN
+        self.bandwidth = bandwidth
+        self.reset()
+
+    def reset(self):
+        self.period = self.nominal_period
+        self.time = None
+        self.time_next = None
+
+    def update(self, t):
+        # Feed in the time a tick arrived, returns the filtered time of that tick
+        if self.time_next is not None:
+            error = t - self.time_next
+
+            # A big jump means the clock stopped or restarted, start over from here
+            if abs(error) > 4 * self.period:
+                self.reset()
+
+        if self.time_next is None:
+            self.time = t
+            self.time_next = t + self.period
+            return self.time
+
+        # Loop gains from the bandwidth at the current tick rate
+        omega = 2 * math.pi * self.bandwidth * self.period
+        b = math.sqrt(2) * omega
+        c = omega * omega
+
+        self.time = self.time_next
+        self.time_next = self.time_next + b * error + self.period
+        self.period = self.period + c * error
+
+        return self.time
+
+    @property
+    def bpm(self):
+        return 60 / (self.period * PPQN)
+
+class SharedClock:
+    # Tempo and position shared between processes through a seqlock: one
+    # writer bumps the sequence number to odd, writes, then bumps it to even.
+    # Readers retry if it was odd or changed while they read. Nobody blocks.
+    def __init__(self, index=0, bpm=100):
+        self.seq = mp.RawValue('Q', 0)
+        self.fields = mp.RawArray('d', len(ClockState._fields))
+        self.write(ClockState(index, time(), 60 / bpm / (PPQN / TICKS_PER_STEP), bpm, 0))
+
+    def write(self, state):
+        self.seq.value = self.seq.value + 1
+        self.fields[:] = [float(x) for x in state]
+        self.seq.value = self.seq.value + 1
+
+    def read(self):
+        while True:
+            seq = self.seq.value
+            if seq % 2:
+                continue
+            fields = self.fields[:]
+            if self.seq.value == seq:
+                index, step_time, period, bpm, tick = fields
+                return ClockState(int(index), step_time, period, bpm, int(tick))
+
+    @property
+    def bpm(self):
+        return self.read().bpm
+
+    def position(self, now=None):
+        # Fractional step index, interpolated from the last step
+        state = self.read()
+        if now is None:
+            now = time()
+        return state.index + (now - state.step_time) / state.period
+
+    def beat_phase(self, now=None):
+        # Where we are within the beat, 0 to 1
+        state = self.read()
+        if now is None:
+            now = time()
+        ticks = state.tick + (now - state.step_time) / state.period * TICKS_PER_STEP
+        return (ticks % PPQN) / PPQN
+
+    def sync(self, index, timestamp):
+        # Tempo comes from the Listener, nothing to learn from steps here
+        return
+
+    def time_of(self, index):
+        # Expected time of a (future) step
+        state = self.read()
+        steps = (index - state.index) % STEPS_PER_YEAR
+        if steps > STEPS_PER_YEAR // 2:
+            # Already behind us
+            steps = steps - STEPS_PER_YEAR
+        return state.step_time + steps * state.period
+
+class SyntheticClock:
+    # Stands in for both the tick bus and the clock when there's no MIDI,
+    # e.g. rendering headless. Steps go by in real time at a fixed tempo,
+    # `speed` times faster to get through a day quicker.
+    def __init__(self, index=0, bpm=100, speed=1):
+        self.start_index = index
+        self.bpm = bpm
+        self.speed = speed
+        self.start_time = time()
+
+    @property
+    def period(self):
+        return 60 / self.bpm / (PPQN / TICKS_PER_STEP) / self.speed
+
+    @property
+    def value(self):
+        return (self.start_index + int((time() - self.start_time) / self.period)) % STEPS_PER_YEAR
@@ -1,61 +1,180 @@
 import pandas as pd
 from datetime import datetime
 import numpy as np
-import pickle
-from pytz import timezone
+import hashlib
+import json
+import os
+import shutil
 import random
 
-def load_data(cached=False):
-    if cached:
-        return pickle.load(open( "data.pickle", "rb") )
-    else:
-        df = pd.read_csv('irradiance.csv')
-
-        # Expand from hourly to minute
-        df_mins = pd.DataFrame(data={'mins': range(0, 60)})
-
-        df['key'] = 0
-        df_mins['key'] = 0
-
-        df = df.merge(df_mins, on='key', how='outer')
-
-        df['Timestamp'] = pd.to_datetime(df['Timestamp']) + pd.to_timedelta(df['mins'], unit='m')
-
-        df.drop(columns=['key', 'mins'], inplace=True)
-
-        # Apply a rolling window and average. Data is reversed to get a forward looking average.
-        df.loc[:, df.columns!='Timestamp'] = df.loc[:, df.columns!='Timestamp'][::-1].rolling(60, min_periods=1).mean()[::-1]
-
-        # Normalize entire dataset between 1.25 and 0, then clip to 1
-        df.loc[:, df.columns!='Timestamp'] = df.loc[:, df.columns!='Timestamp'].apply(lambda x: 1.25 * (x - x.min())/(x.max() - x.min())).clip(upper=1)
+CACHE_DIR = 'data_cache'
 
-        #Add new column with brightness, created from sine waves randomly varying in frequency
-        s = pd.Series(dtype='float')
+# Anything that changes the built dataset goes in here, so a change
+# invalidates the cache the same way an edit to the CSV does
+# window: minutes in the forward looking average
+# scale: normalised values are scaled to this, then clipped to 1
+BUILD_PARAMS = {'version': 1, 'window': 60, 'scale': 1.25}
 
-        while len(s) < len(df):
-            s = pd.concat([s, np.sin(pd.Series(range(0, 360, random.randint(1, 5))) * np.pi / 180)])
-
-        df = df.merge(s.rename('Brightness', inplace=True).reset_index(), how='left', left_index=True, right_index=True)
+def load_data(cached=False, path='irradiance.csv'):
+    if cached:
+        return columns_to_frame(load_columns(path))
+    else:
+        df = build_data(path)
 
-        pickle.dump(df, open( "data.pickle", "wb"))
+        save_columns(df, cache_key(path))
 
         return df
 
-
-def get_start_index(df):
-
-    start_time = datetime.now()
-    decimal_time = int(start_time.hour)/24 + int(start_time.minute)/(24*60) + int(start_time.second)/(24*60*60)
-
-    first_date = datetime(year=2022, month=12, day=21)
-    data_duration = (365*24*60*60)
-
-    data_start_time = first_date.timestamp() + (decimal_time * data_duration)
-
-    data_start_time = datetime.fromtimestamp(data_start_time, timezone('Etc/GMT+8'))
-
-    # Filter to correct point in data based on time of day
-    return df[df['Timestamp'] > np.datetime64(data_start_time)].head(1).index[0]
+def cache_key(path='irradiance.csv'):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps(BUILD_PARAMS, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+def frame_to_columns(df):
+    # Compact on disk layout: int64 epoch seconds and float32 values
+    columns = {}
+    for col in df.columns:
+        if col == 'Timestamp':
+            columns[col] = df[col].to_numpy(dtype='datetime64[s]').astype(np.int64)
+        else:
+            columns[col] = df[col].to_numpy(dtype=np.float32)
+    return columns
+
+def columns_to_frame(columns):
+    data = {}
+    for col, values in columns.items():
+        if col == 'Timestamp':
+            data[col] = values.astype('datetime64[s]').astype('datetime64[ns]')
+        else:
+            data[col] = values
+    return pd.DataFrame(data)
+
+def save_columns(df, key):
+    path = os.path.join(CACHE_DIR, key)
+    tmp_path = path + '.tmp'
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # Column names have spaces in them, so files are numbered and named in the manifest
+    columns = frame_to_columns(df)
+    for n, values in enumerate(columns.values()):
+        np.save(os.path.join(tmp_path, str(n) + '.npy'), values)
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump({'key': key, 'columns': list(columns), 'params': BUILD_PARAMS}, f)
+
+    # Swap the new build in and drop any stale ones
+    for old in os.listdir(CACHE_DIR):
+        if old != key + '.tmp':
+            shutil.rmtree(os.path.join(CACHE_DIR, old), ignore_errors=True)
+    os.rename(tmp_path, path)
+
+def load_columns(path='irradiance.csv'):
+    # Memory mapped columns for the current CSV and build params, rebuilt if missing or stale
+    key = cache_key(path)
+    cache_path = os.path.join(CACHE_DIR, key)
+
+    try:
+        with open(os.path.join(cache_path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['key'] != key:
+            raise ValueError('Cache key mismatch')
+        return {col: np.load(os.path.join(cache_path, str(n) + '.npy'), mmap_mode='r')
+                for n, col in enumerate(manifest['columns'])}
+    except (OSError, ValueError, KeyError):
+        print('Rebuilding data cache ' + key)
+        save_columns(build_data(path), key)
+        return load_columns(path)
+
+def forward_mean(values, window=60):
+    # Same as reversing, taking a rolling mean with min_periods=1 and reversing
+    # back, i.e. the mean of each value and the (up to) window-1 values after it
+    n = len(values)
+    valid = ~np.isnan(values)
+
+    sums = np.zeros(n + 1)
+    np.cumsum(np.where(valid, values, 0), out=sums[1:])
+    counts = np.zeros(n + 1)
+    np.cumsum(valid, out=counts[1:])
+
+    start = np.arange(n)
+    end = np.minimum(start + window, n)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[end] - sums[start]) / (counts[end] - counts[start])
+
+def sine_brightness(n):
+    # Sine waves randomly varying in frequency, written straight into one buffer
+    waves = {}
+    brightness = np.empty(n)
+    pos = 0
+
+    while pos < n:
+        step = random.randint(1, 5)
+        if step not in waves:
+            waves[step] = np.sin(np.arange(0, 360, step) * np.pi / 180)
+        wave = waves[step]
+
+        end = min(pos + len(wave), n)
+        brightness[pos:end] = wave[:end - pos]
+        pos = end
+
+    return brightness
+
+def build_data(path='irradiance.csv', params=BUILD_PARAMS):
+    df_hours = pd.read_csv(path)
+
+    # Expand from hourly to minute
+    hours = pd.to_datetime(df_hours['Timestamp'], format='%m/%d/%y %H:%M').to_numpy()
+    minutes = np.arange(60).astype('timedelta64[m]')
+    data = {'Timestamp': (hours[:, None] + minutes[None, :]).reshape(-1)}
+
+    for col in df_hours.columns:
+        if col == 'Timestamp':
+            continue
+
+        # Hourly values repeated per minute, then a forward looking average
+        values = forward_mean(np.repeat(df_hours[col].to_numpy(dtype=np.float64), 60), params['window'])
+
+        # Normalize between scale (1.25) and 0, then clip to 1
+        values -= np.nanmin(values)
+        values *= params['scale'] / np.nanmax(values)
+        np.minimum(values, 1, out=values)
+
+        data[col] = values
+
+    #Add new column with brightness, created from sine waves randomly varying in frequency
+    data['Brightness'] = sine_brightness(len(data['Timestamp']))
+
+    return pd.DataFrame(data)
+
+
+DATA_FIRST_DATE = datetime(year=2022, month=12, day=21)
+DATA_DURATION = 365*24*60*60
+DATA_LENGTH = 525600
+
+def get_data_time(when=None):
+    # A whole year of data plays out over one real day, so the time of day maps
+    # to a point in the year. Returned as epoch seconds on the data's clock.
+    if when is None:
+        when = datetime.now()
+    decimal_time = int(when.hour)/24 + int(when.minute)/(24*60) + int(when.second)/(24*60*60)
+
+    return DATA_FIRST_DATE.timestamp() + (decimal_time * DATA_DURATION)
+
+def get_index(first_timestamp, when=None, length=DATA_LENGTH):
+    # Index of the first minute strictly after the data time for `when`.
+    # The data is a regular minute grid starting at first_timestamp (epoch
+    # seconds), so this is arithmetic rather than a search. Cheap enough to
+    # call mid-run to resync the clock to wall time.
+    data_time = get_data_time(when)
+    return (int((data_time - first_timestamp) // 60) + 1) % length
+
+def get_start_index(df, when=None):
+    first_timestamp = df['Timestamp'].iloc[0].to_datetime64().astype('datetime64[s]').astype(np.int64)
+    return get_index(int(first_timestamp), when, len(df))
 
 if __name__ == '__main__':
     df = load_data(cached=False)
@@ -1,119 +1,365 @@
-from platypush.context import get_plugin
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
+from zigbee import get_backend
+from metrics import histogram, counter
 
 N_BULBS = 6
 N_PLUGS = 0
 
+# Bulbs 1-6 follow sensors 1-6, any others are always on
+N_SENSOR_BULBS = 6
+
+# zigbee2mqtt group containing every bulb (set up in the Zigbee UI)
+BULB_GROUP = 'Bulbs'
+
+# Message budget for the whole Zigbee network. Anything over budget waits,
+# and is replaced by newer values if they arrive in the meantime.
+MAX_MESSAGES_PER_SECOND = 15
+MAX_MESSAGE_BURST = N_BULBS + 1
+
+# Longest we wait on any one device message before giving up on it
+SEND_TIMEOUT = 0.5
+
+class RateLimiter:
+    # Token bucket
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time_last = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time_last) * self.rate)
+        self.time_last = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens = self.tokens - 1
+            return True
+        return False
+
+    def available(self):
+        # Messages that could go out right now
+        self.refill()
+        return int(self.tokens)
+
+    def wait_time(self):
+        # Seconds until the next message can go out
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+class DeviceStates:
+    # What each device should be showing versus the last values the backend accepted
+    def __init__(self, names):
+        self.desired = {name: {} for name in names}
+        self.acked = {name: {} for name in names}
+
+        # When each device fell behind, None while it's up to date
+        self.stale_since = {name: None for name in names}
+
+    def set(self, name, payload):
+        # Newer values simply overwrite older ones that haven't gone out yet
+        self.desired[name].update(payload)
+        self.update_stale(name)
+
+    def pending(self, name):
+        acked = self.acked[name]
+        return {k: v for k, v in self.desired[name].items() if acked.get(k) != v}
+
+    def ack(self, name, payload):
+        self.acked[name].update(payload)
+        self.update_stale(name)
+
+    def forget(self, name):
+        # Device state unknown (e.g. it dropped off the mesh), resend everything
+        self.acked[name] = {}
+        self.update_stale(name)
+
+    def update_stale(self, name):
+        if not self.pending(name):
+            self.stale_since[name] = None
+        elif self.stale_since[name] is None:
+            self.stale_since[name] = monotonic()
+
 class Devices:
-    def __init__(self, df):
-        self.df = df
+    def __init__(self, timeline, backend='mqtt', rate=MAX_MESSAGES_PER_SECOND, burst=MAX_MESSAGE_BURST, metrics=None):
+        self.timeline = timeline
+        self.bulb_names = ['Bulb ' + str(s+1) for s in range(N_BULBS)]
+        self.plug_names = ['Plug ' + str(s+1) for s in range(N_PLUGS)]
 
-    def convert_to_color(self, num):
-        red = 0.7539, 0.2746
-        green = 0.0771, 0.8268
+        # Either a backend name ('mqtt' or 'platypush') or a backend object
+        if isinstance(backend, str):
+            backend = get_backend(backend)
+        self.backend = backend
 
-        x_scale = red[0] - green[0]
-        y_scale = red[1] - green[1]
+        self.states = DeviceStates(self.bulb_names + self.plug_names)
+        self.limiter = RateLimiter(rate, burst)
 
-        x = red[0] - (num * x_scale)
-        y = red[1] - (num * y_scale)
+        self.step_lag = histogram(metrics, 'devices.step_lag')
+        self.send_latency = histogram(metrics, 'devices.send_latency')
+        self.step_latency_metric = histogram(metrics, 'devices.step_latency')
+        self.messages = counter(metrics, 'devices.messages')
+        self.send_failures = counter(metrics, 'devices.send_failures')
 
-        return {'x':x, 'y':y}
-            
-    def update_bulbs_brightness(self, value, sensor_flags):
-        # Always update 7 thru 10
-        for s in (range(N_BULBS-6)):
-            bulb_name = 'Bulb ' + str(s+7)
+    def send(self, name, payload, names=None):
+        # One combined message to a device or group, counted against the budget.
+        # Returns False if it didn't go out.
+        if not self.limiter.take():
+            return False
+        start = time()
+        try:
+            self.backend.send(name, payload)
+        except Exception as e:
+            print("WARNING: Devices failed to update " + name + " (" + str(e) + ")")
+            self.send_failures.add()
+            self.forget(names or [name])
+            return False
+        self.send_latency.observe(time() - start)
+        self.messages.add()
+        return True
 
-            # print('Setting ' + bulb_name + ' brightness to ' + str(value))
-            get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=value)
+    def forget(self, names):
+        # A failed or timed out message may have been half applied, so the
+        # next attempt sends these devices everything again
+        for name in names:
+            self.states.forget(name)
 
-        # Update bulbs 1-6
-        for s in range(6):
-            bulb_name = 'Bulb ' + str(s+1)
+    def bulb_brightness(self, s, value, sensor_states):
+        # If we have sensors and the bulb's sensor is off, the bulb is off
+        if sensor_states is not None and s < N_SENSOR_BULBS and not sensor_states[s]:
+            return 0
+        return value
+
+    def set_step(self, idx, sensor_states):
+        # Desired state of every device for this step
+        color = self.timeline.color(idx)
+        brightness = int(self.timeline.brightness[idx])
+        plug_state = self.timeline.plug_state(idx)
+
+        for s, name in enumerate(self.bulb_names):
+            self.states.set(name, {'color': color, 'brightness': self.bulb_brightness(s, brightness, sensor_states)})
+
+        for name in self.plug_names:
+            self.states.set(name, {'state': plug_state})
+
+    def plan_bulbs(self):
+        pending = {name: self.states.pending(name) for name in self.bulb_names}
+        pending = {name: payload for name, payload in pending.items() if payload}
+        if not pending:
+            return []
+
+        # Cheapest of three plans, the safer one when they tie:
+        # 1. A message per bulb
+        plans = [[(name, payload, [name]) for name, payload in pending.items()]]
+
+        # 2. Properties every bulb wants the same value of (usually colour) to
+        # the whole group, and the rest per bulb
+        desired = [self.states.desired[name] for name in self.bulb_names]
+        shared = {k: v for k, v in desired[0].items() if all(d.get(k) == v for d in desired[1:])}
+        shared = {k: v for k, v in shared.items() if any(k in payload for payload in pending.values())}
+        if shared:
+            plans.append([(BULB_GROUP, shared, self.bulb_names)] + self.after_group(shared))
+
+        # 3. The state most bulbs want, brightness included, to the group, then
+        # overrides for the bulbs that want something else (e.g. empty seats).
+        # Those bulbs show the group's state until their override lands, so
+        # this is only used when the budget covers every override right away
+        # and none of them can be left waiting.
+        keys = {name: tuple(sorted((k, str(v)) for k, v in self.states.desired[name].items())) for name in self.bulb_names}
+        majority_key, _ = Counter(keys.values()).most_common(1)[0]
+        majority = self.states.desired[next(name for name in self.bulb_names if keys[name] == majority_key)]
+        majority = {k: v for k, v in majority.items() if any(k in payload for payload in pending.values())}
+        if majority and majority != shared:
+            plan = [(BULB_GROUP, majority, self.bulb_names)] + self.after_group(majority)
+            if len(plan) <= self.limiter.available():
+                plans.append(plan)
+
+        return min(plans, key=len)
+
+    def after_group(self, group_payload):
+        # Per bulb messages for whatever still differs once group_payload has
+        # gone to every bulb
+        messages = []
+        for name in self.bulb_names:
+            after = dict(self.states.acked[name])
+            after.update(group_payload)
+            payload = {k: v for k, v in self.states.desired[name].items() if after.get(k) != v}
+            if payload:
+                messages.append((name, payload, [name]))
+        return messages
+
+    def plan(self):
+        # Messages that bring every device up to date, as
+        # (target, payload, devices it updates). A group message comes first,
+        # then the devices that have been waiting longest, so when the budget
+        # runs out it isn't always the same devices left behind.
+        messages = self.plan_bulbs()
+        for name in self.plug_names:
+            payload = self.states.pending(name)
+            if payload:
+                messages.append((name, payload, [name]))
+
+        group = [message for message in messages if message[0] == BULB_GROUP]
+        devices = [message for message in messages if message[0] != BULB_GROUP]
+        devices.sort(key=lambda message: self.states.stale_since[message[2][0]] or 0)
+        return group + devices
+
+    def flush(self):
+        # Send real changes only, as far as the budget allows.
+        # Returns True once nothing is left pending.
+        for target, payload, names in self.plan():
+            # print('Setting ' + target + ' to ' + str(payload))
+            if not self.send(target, payload, names):
+                return False
+            for name in names:
+                self.states.ack(name, payload)
+        return True
 
-            # If we have sensors and those sensors are on, set brightness
-            if sensor_flags is not None:
-                if sensor_flags[s].value:
-                    # print('Setting ' + bulb_name + ' brightness to ' + str(value))
-                    get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=value)
-                else:
-                    # print('Setting ' + bulb_name + ' brightness to 0')
-                    get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=0)
-            else:
-                # If no sensors, always set brightness
-                # print('Setting ' + bulb_name + ' brightness to ' + str(value))
-                get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=value)
-
-
-    def update_bulbs_color(self, value):
-        # Update bulbs 1-10
-        for s in range(N_BULBS):
-            bulb_name = 'Bulb ' + str(s+1)
-            # print('Setting ' + bulb_name + ' color to ' + str(value))
-            get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='color', value=value)
-
-    def toggle_plugs(self, value):
-        for s in range(N_PLUGS):
-            plug_name = 'Plug ' + str(s+1)
-            get_plugin('zigbee.mqtt').device_set(device=plug_name, property='state', value=value)
-        
     def run(self, i, sensor_flags):
         i_last = -1
-        last_color = -1
-        last_brightness = -1
-        last_plug_state = 'Unknown'
+        sensor_flags_last = None
+        tick_count = -1
+        timeout = None
+
+        while True:
+            # Block until the clock publishes a new step, or until the budget
+            # allows another go at whatever is still pending
+            tick = i.wait(tick_count, timeout)
+
+            if tick is not None:
+                tick_count = tick.count
+                self.step_lag.observe(time() - tick.timestamp)
+                if tick.missed:
+                    print('WARNING: Devices missed ' + str(tick.missed) + ' steps')
+
+            # Every sensor in one read, its sequence number says whether any changed
+            sensor_flags_now = None
+            if sensor_flags is not None:
+                sensor_flags_now = sensor_flags.read()
+
+            # timestep or sensors have changed
+            if (tick is not None and tick.index != i_last) or sensor_flags_now != sensor_flags_last:
+                if tick is not None:
+                    i_last = tick.index
+                self.set_step(i_last, sensor_flags_now.flags if sensor_flags_now is not None else None)
+                sensor_flags_last = sensor_flags_now
+
+            if self.flush():
+                timeout = None
+            else:
+                # Over budget or failed, try again when there's a token
+                timeout = max(self.limiter.wait_time(), 0.01)
+
+class AsyncDevices(Devices):
+    # Same state tracking as Devices, but messages to independent devices go
+    # out concurrently so one slow bulb doesn't hold up the rest
+    def __init__(self, timeline, backend='mqtt', rate=MAX_MESSAGES_PER_SECOND, burst=MAX_MESSAGE_BURST, timeout=SEND_TIMEOUT, metrics=None):
+        super().__init__(timeline, backend, rate, burst, metrics)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=N_BULBS + N_PLUGS + 1)
+
+        # Seconds from a step being published to all of its messages completing
+        self.step_latency = None
+        self.step_latencies = deque(maxlen=1000)
+
+    async def send_async(self, target, payload, names):
+        if not self.limiter.take():
+            return False
+
+        loop = asyncio.get_event_loop()
+        start = time()
+        try:
+            await asyncio.wait_for(loop.run_in_executor(self.executor, self.backend.send, target, payload), self.timeout)
+        except asyncio.TimeoutError:
+            print("WARNING: Devices timed out updating " + target)
+            self.send_failures.add()
+            self.forget(names)
+            return False
+        except asyncio.CancelledError:
+            # Superseded by a newer step, whatever it was sending is stale
+            raise
+        except Exception as e:
+            print("WARNING: Devices failed to update " + target + " (" + str(e) + ")")
+            self.send_failures.add()
+            self.forget(names)
+            return False
+        self.send_latency.observe(time() - start)
+        self.messages.add()
+
+        for name in names:
+            self.states.ack(name, payload)
+        return True
+
+    async def flush_async(self, step_time):
+        messages = self.plan()
 
-        if sensor_flags is not None:
-            sensor_flags_last = [-1, -1, -1, -1, -1, -1]
+        # Overrides of a group message have to land after it. Otherwise
+        # everything goes at once.
+        if messages and messages[0][0] == BULB_GROUP:
+            group_keys = set(messages[0][1])
+            if any(group_keys & set(payload) for _, payload, _ in messages[1:]):
+                if not await self.send_async(*messages[0]):
+                    return False
+                messages = messages[1:]
+
+        results = await asyncio.gather(*[self.send_async(*message) for message in messages])
+
+        # Recorded whether or not everything got through, timeouts included
+        self.step_latency = time() - step_time
+        self.step_latencies.append(self.step_latency)
+        self.step_latency_metric.observe(self.step_latency)
+
+        return all(results)
+
+    async def run_async(self, i, sensor_flags):
+        loop = asyncio.get_event_loop()
+
+        i_last = -1
+        sensor_flags_last = None
+        tick_count = -1
+        step_time = time()
+        step_task = None
+        timeout = None
 
         while True:
-            if i.value != i_last: # timestep has changed
-
-                row = self.df.iloc[i.value]
-                color = self.convert_to_color(row['Direct Beam'])
-                brightness = int(126 * row['Brightness'] + 128)
-                plug_state = 'ON' if row['Direct Beam'] < 0.25 else 'OFF'
-
-                if sensor_flags is not None:
-                    sensor_flags_last = [-1, -1, -1, -1, -1, -1]
-
-                try:
-                    if color != last_color:
-                        # print('setting color to ' + str(color))
-                        self.update_bulbs_color(color)
-                    if (brightness != last_brightness):
-                        # print('setting brightness to ' + str(brightness))
-                        self.update_bulbs_brightness(brightness, sensor_flags)
-                    if plug_state != last_plug_state:
-                        print('setting plug state to ' + plug_state)
-                        self.toggle_plugs(plug_state)
-                except:
-                    print("WARNING: Devices failed to update")
+            # Wait for the clock in a worker thread so sends keep running meanwhile
+            tick = await loop.run_in_executor(None, i.wait, tick_count, timeout)
+
+            if tick is not None:
+                tick_count = tick.count
+                self.step_lag.observe(time() - tick.timestamp)
+                if tick.missed:
+                    print('WARNING: Devices missed ' + str(tick.missed) + ' steps')
+
+            # Every sensor in one read, its sequence number says whether any changed
+            sensor_flags_now = None
+            if sensor_flags is not None:
+                sensor_flags_now = sensor_flags.read()
+
+            changed = (tick is not None and tick.index != i_last) or sensor_flags_now != sensor_flags_last
+            if changed:
+                if tick is not None:
+                    i_last = tick.index
+                    step_time = tick.timestamp
+                self.set_step(i_last, sensor_flags_now.flags if sensor_flags_now is not None else None)
+                sensor_flags_last = sensor_flags_now
+
+            # New desired state cancels whatever is still in flight for the old one.
+            # Otherwise only start again once the last attempt has finished.
+            if step_task is not None and not step_task.done():
+                if not changed:
                     continue
+                step_task.cancel()
 
-                # If we have sensors
-                if sensor_flags is not None:
-                    # For every sensor, 
-                    for sensor_id in range(6):
-                        # If the value has changed
-                        if sensor_flags[sensor_id].value != sensor_flags_last[sensor_id]:
-                            bulb_name = 'Bulb ' + str(sensor_id+1)
-                            # If the sensor is off
-                            try:
-                                if not sensor_flags[sensor_id].value:
-                                    # Switch bulb off
-                                    # print('Setting ' + bulb_name + ' brightness to 0')
-                                    get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=0)
-                                else:
-                                    # Switch bulb on
-                                    get_plugin('zigbee.mqtt').device_set(device=bulb_name, property='brightness', value=brightness)
-                            except:
-                                print("WARNING: Devices failed to update")
-                                continue
-                        # Update last sensor flags
-                        sensor_flags_last[sensor_id] = sensor_flags[sensor_id].value
-
-                i_last = i.value
-                last_color = color
-                last_brightness = brightness
-                last_plug_state = plug_state
\ No newline at end of file
+            if changed or (step_task is not None and not step_task.result()):
+                step_task = asyncio.ensure_future(self.flush_async(step_time))
+
+            # Come back when there's budget to retry, if anything is left over
+            timeout = max(self.limiter.wait_time(), 0.05) if self.plan() else None
+
+    def run(self, i, sensor_flags):
+        asyncio.get_event_loop().run_until_complete(self.run_async(i, sensor_flags))
@@ -0,0 +1,187 @@
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# Warp offsets kept, one per phase. Enough for a full cycle (num_frames is at
+# most 100). Only a row and a column are kept, about 8 KB each for 800x600.
+WARP_CACHE_SIZE = 100
+
+class WarpMaps:
+    # Fixed point remap tables for the wavy warp, memoised per phase.
+    # They only depend on the phase (n % num_frames) and the frame size.
+    # The warp is separable, x moves with the column and y with the row, so
+    # we keep the fixed point offsets for one row and one column and spread
+    # them out to full maps per frame. That's well under a millisecond, where
+    # keeping full maps for a cycle would be almost 300 MB.
+    def __init__(self, amount_x=10, amount_y=5, maxsize=WARP_CACHE_SIZE):
+        self.amount_x = amount_x
+        self.amount_y = amount_y
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+        # Clips being played and preloaded warp from different threads
+        self.lock = threading.Lock()
+
+    def build(self, phase, num_frames, w, h):
+        # set wavelength
+        wave_x = 2*w
+        wave_y = h
+
+        # create X and Y ramps
+        x = np.arange(w, dtype=np.float32)
+        y = np.arange(h, dtype=np.float32)
+
+        # compute phase to increment over 360 degree for number of frames specified so makes full cycle
+        phase_x = phase*360/num_frames
+        phase_y = phase_x
+
+        # create sinusoids in X and Y, add to ramps
+        x_sin = self.amount_x * np.sin(2 * np.pi * (x/wave_x + phase_x/360)) + x
+        y_sin = self.amount_y * np.sin(2 * np.pi * (y/wave_y + phase_y/360)) + y
+
+        # Fixed point maps are much quicker for remap to use. Converting
+        # against zeros keeps each axis on its own: the integer part goes in
+        # its half of map1 and the fraction in its bits of the map2 index.
+        x1, x2 = cv2.convertMaps(x_sin[None, :].astype(np.float32), np.zeros((1, w), np.float32), cv2.CV_16SC2)
+        y1, y2 = cv2.convertMaps(np.zeros((h, 1), np.float32), y_sin[:, None].astype(np.float32), cv2.CV_16SC2)
+        return x1[0, :, 0], x2[0], y1[:, 0, 1], y2[:, 0]
+
+    def expand(self, offsets):
+        # Full remap tables from one row and one column
+        x1, x2, y1, y2 = offsets
+        map1 = np.empty((len(y1), len(x1), 2), dtype=np.int16)
+        map1[:, :, 0] = x1[None, :]
+        map1[:, :, 1] = y1[:, None]
+
+        # The interpolation index is y fraction * 32 + x fraction
+        map2 = np.add(y2[:, None], x2[None, :])
+        return map1, map2
+
+    def get(self, n, num_frames, w, h):
+        key = (n % num_frames, num_frames, w, h)
+        with self.lock:
+            offsets = self.cache.get(key)
+            if offsets is not None:
+                self.cache.move_to_end(key)
+
+        if offsets is None:
+            offsets = self.build(n % num_frames, num_frames, w, h)
+            with self.lock:
+                self.cache[key] = offsets
+                if len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+        return self.expand(offsets)
+
+    def warp(self, frame, n, num_frames, dst=None):
+        h, w = frame.shape[:2]
+        map1, map2 = self.get(n, num_frames, w, h)
+        return cv2.remap(frame, map1, map2, cv2.INTER_CUBIC, dst=dst, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+
+# Brightness tables kept, reductions only change once a step
+COLOUR_CACHE_SIZE = 16
+
+def brightness_lut(reduction):
+    # What the HSV version did to V: subtract and clamp
+    return np.clip(np.arange(256) - reduction, 0, 255).astype(np.uint8)
+
+class ColourStage:
+    # Brightness and the blue/red swap in one pass, into preallocated buffers.
+    # Taking `reduction` off V (= max(B, G, R)) with H and S unchanged scales
+    # every channel by lut[V] / V, so we look that factor up per pixel rather
+    # than going through HSV and back. Black pixels stay black, which only
+    # differs from HSV for negative reductions (brightening) and we never do that.
+    def __init__(self, width, height, maxsize=COLOUR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+        self.channels = [np.empty((height, width), np.uint8) for _ in range(3)]
+        self.swapped = [np.empty((height, width), np.uint8) for _ in range(3)]
+        self.v = np.empty((height, width), np.uint8)
+        self.scale = np.empty((height, width), np.float32)
+
+    def get(self, reduction):
+        # Anything past 255 either way is the same table
+        key = int(round(min(max(reduction, -255), 255)))
+        table = self.cache.get(key)
+        if table is None:
+            lut = brightness_lut(key)
+            table = np.zeros((1, 256), np.float32)
+            table[0, 1:] = lut[1:] / np.arange(1, 256)
+            self.cache[key] = table
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return table
+
+    def apply(self, frame, reduction, dst=None):
+        # frame is BGR, result is RGB with the brightness taken down
+        b, g, r = cv2.split(frame, self.channels)
+        cv2.max(b, g, dst=self.v)
+        cv2.max(self.v, r, dst=self.v)
+        cv2.LUT(self.v, self.get(reduction), dst=self.scale)
+
+        for src, out in zip((r, g, b), self.swapped):
+            cv2.multiply(src, self.scale, dst=out, dtype=cv2.CV_8U)
+
+        return cv2.merge(self.swapped, dst=dst)
+
+class TextOverlay:
+    # Text layers rasterised once, when their text changes, into alpha masks
+    # cropped to the glyphs. Each frame then just blends the masks on.
+    # ft is anything with freetype's putText, only used when text changes.
+    def __init__(self, ft, width, height, color=(255, 255, 255)):
+        self.ft = ft
+        self.color = color
+        self.canvas = np.zeros((height, width, 3), np.uint8)
+        self.keys = {}
+        self.layers = {}
+
+    def render(self, text, org, font_height):
+        # Returns (y, x, frame weights, text weights, text colour, scratch) for
+        # the glyphs' bounding box, or None if nothing shows
+        self.canvas[:] = 0
+        self.ft.putText(img=self.canvas,
+            text=text,
+            org=org,
+            fontHeight=font_height,
+            color=(255, 255, 255),
+            thickness=-1,
+            line_type=cv2.LINE_AA,
+            bottomLeftOrigin=True)
+
+        coverage = self.canvas[:, :, 0]
+        rows = np.flatnonzero(coverage.any(axis=1))
+        cols = np.flatnonzero(coverage.any(axis=0))
+        if len(rows) == 0:
+            return None
+
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = cols[0], cols[-1] + 1
+        alpha = coverage[y0:y1, x0:x1].astype(np.float32) / 255
+        fill = np.empty((y1 - y0, x1 - x0, 3), np.uint8)
+        fill[:] = self.color
+        return y0, x0, 1 - alpha, alpha, fill, np.empty_like(fill)
+
+    def set(self, name, text, org, font_height):
+        # Cheap when nothing has changed, so fine to call every frame
+        key = (text, org, font_height)
+        if self.keys.get(name) == key:
+            return
+        self.keys[name] = key
+
+        layer = self.render(text, org, font_height) if text else None
+        if layer is None:
+            self.layers.pop(name, None)
+        else:
+            self.layers[name] = layer
+
+    def blend(self, frame):
+        # In place, frame * (1 - alpha) + colour * alpha over each layer's box
+        for y, x, frame_weights, text_weights, fill, scratch in self.layers.values():
+            h, w = fill.shape[:2]
+            roi = frame[y:y+h, x:x+w]
+            cv2.blendLinear(roi, fill, frame_weights, text_weights, dst=scratch)
+            roi[:] = scratch
+        return frame
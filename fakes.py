@@ -0,0 +1,233 @@
+import json
+import random
+import sys
+import threading
+import types
+from collections import namedtuple
+from time import time, sleep, perf_counter
+
+# In-process stand-ins for the hardware facing libraries, so the device,
+# audio and sensor code can be exercised without a broker or MIDI ports.
+# See simulate.py for them all wired together.
+
+### MQTT ###
+
+FakeMessageInfo = namedtuple('FakeMessageInfo', ['rc', 'mid'])
+FakeMessage = namedtuple('FakeMessage', ['topic', 'payload', 'qos', 'timestamp'])
+
+def topic_matches(sub, topic):
+    # MQTT wildcard matching for + and #
+    sub_parts = sub.split('/')
+    topic_parts = topic.split('/')
+    for n, part in enumerate(sub_parts):
+        if part == '#':
+            return True
+        if n >= len(topic_parts) or (part != '+' and part != topic_parts[n]):
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+class FakeMqttBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self.clients = []
+
+    def publish(self, topic, payload, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        msg = FakeMessage(topic, payload, qos, time())
+        with self.lock:
+            self.messages.append(msg)
+            clients = list(self.clients)
+        for client in clients:
+            client.deliver(msg)
+
+    def messages_for(self, topic):
+        with self.lock:
+            return [msg for msg in self.messages if topic_matches(topic, msg.topic)]
+
+    def clear(self):
+        with self.lock:
+            self.messages = []
+
+class FakeMqttClient:
+    # The subset of paho.mqtt.client.Client used in this repo
+    def __init__(self, broker, userdata=None):
+        self.broker = broker
+        self.userdata = userdata
+        self.subscriptions = []
+        self.inbox = []
+        self.inbox_ready = threading.Condition()
+        self.connected = False
+        self.mid = 0
+        self.on_message = None
+        self.on_connect = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_log = None
+
+    def username_pw_set(self, username, password=None):
+        return
+
+    def connect(self, host, port=1883):
+        self.connected = True
+        with self.broker.lock:
+            self.broker.clients.append(self)
+        if self.on_connect:
+            self.on_connect(self, self.userdata, {}, 0)
+        return 0
+
+    def disconnect(self):
+        self.connected = False
+        with self.broker.lock:
+            if self in self.broker.clients:
+                self.broker.clients.remove(self)
+        return 0
+
+    def loop_start(self):
+        return
+
+    def loop_stop(self):
+        return
+
+    def loop(self, timeout=1.0):
+        # Hand queued messages to on_message, like paho's network loop
+        with self.inbox_ready:
+            if not self.inbox:
+                self.inbox_ready.wait(timeout)
+            inbox, self.inbox = self.inbox, []
+        for msg in inbox:
+            if self.on_message:
+                self.on_message(self, self.userdata, msg)
+        return 0 if self.connected else 4
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for sub, _ in topics:
+            self.subscriptions.append(sub)
+        self.mid = self.mid + 1
+        return (0, self.mid)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            return FakeMessageInfo(4, 0)
+        self.broker.publish(topic, payload, qos)
+        self.mid = self.mid + 1
+        return FakeMessageInfo(0, self.mid)
+
+    def deliver(self, msg):
+        if any(topic_matches(sub, msg.topic) for sub in self.subscriptions):
+            with self.inbox_ready:
+                self.inbox.append(msg)
+                self.inbox_ready.notify()
+
+def install_mqtt(broker):
+    # Make `import paho.mqtt.client` (and platypush's zigbee plugin) hand out
+    # fakes on `broker`. Call before importing the code under test.
+    client_module = types.ModuleType('paho.mqtt.client')
+    client_module.Client = lambda *args, userdata=None, **kwargs: FakeMqttClient(broker, userdata)
+    mqtt_module = types.ModuleType('paho.mqtt')
+    mqtt_module.client = client_module
+    paho_module = types.ModuleType('paho')
+    paho_module.mqtt = mqtt_module
+
+    plugin = FakeZigbeePlugin(broker)
+    context_module = types.ModuleType('platypush.context')
+    context_module.get_plugin = lambda name: plugin
+    platypush_module = types.ModuleType('platypush')
+    platypush_module.context = context_module
+
+    sys.modules.update({
+        'paho': paho_module,
+        'paho.mqtt': mqtt_module,
+        'paho.mqtt.client': client_module,
+        'platypush': platypush_module,
+        'platypush.context': context_module,
+    })
+
+class FakeZigbeePlugin:
+    # platypush's zigbee.mqtt plugin, as far as get_plugin('zigbee.mqtt').publish goes
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, topic, msg, qos=0):
+        if not isinstance(msg, (bytes, str)):
+            msg = json.dumps(msg)
+        self.broker.publish(topic, msg, qos)
+
+### MIDI ###
+
+class FakeMidiPort:
+    # A mido port, input or output. Sent messages are kept with the time they
+    # were sent, input messages go to `callback` as with a real mido port.
+    def __init__(self, name='fake'):
+        self.name = name
+        self.lock = threading.Lock()
+        self.sent = []
+        self.callback = None
+        self.closed = False
+
+    def send(self, msg):
+        with self.lock:
+            self.sent.append((time(), msg))
+
+    def feed(self, msg):
+        if self.callback is not None:
+            self.callback(msg)
+
+    def sent_times(self):
+        with self.lock:
+            return [t for t, _ in self.sent]
+
+    def close(self):
+        self.closed = True
+
+def install_midi(port):
+    # Every mido.open_input/open_output returns `port`
+    import mido
+    mido.open_input = lambda *args, **kwargs: port
+    mido.open_output = lambda *args, **kwargs: port
+
+class SyntheticMidiClock:
+    # Sends a MIDI start then clock ticks at `bpm` into a port from its own
+    # thread, with optional random jitter on each tick (in seconds), and keeps
+    # the time each step (every `ticks_per_step` ticks) started
+    def __init__(self, port, bpm=120, ppqn=24, ticks_per_step=6, jitter=0):
+        self.port = port
+        self.bpm = bpm
+        self.ppqn = ppqn
+        self.ticks_per_step = ticks_per_step
+        self.jitter = jitter
+        self.step_times = []
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='midi-clock', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        import mido
+        period = 60 / self.bpm / self.ppqn
+        self.port.feed(mido.Message('start'))
+        next_time = perf_counter()
+        ticks = 0
+        while self.running:
+            # Sleep most of the way, spin the rest
+            target = next_time + random.uniform(-self.jitter, self.jitter)
+            while perf_counter() < target - 0.002:
+                sleep(0.001)
+            while perf_counter() < target:
+                pass
+
+            if ticks % self.ticks_per_step == 0:
+                self.step_times.append(time())
+            self.port.feed(mido.Message('clock'))
+
+            ticks = ticks + 1
+            next_time = next_time + period
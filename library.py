@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import cv2
+import numpy as np
+from collections import namedtuple
+
+VIDEO_DIR = 'videos'
+PROXY_DIR = 'videos_proxy'
+VIDEO_EXTENSIONS = ('.mp4', '.mov')
+
+# Proxies are motion JPEG, every frame is a keyframe so looping and seeking
+# are just a jump, and decoding is cheap
+PROXY_CODEC = 'MJPG'
+PROXY_EXTENSION = '.avi'
+PROXY_SIZE = (800, 600)
+
+# Thumbnail size used to find a loop point that matches the first frame
+THUMB_SIZE = (32, 24)
+
+# Bump to rebuild every entry (and proxy) next time the indexer runs
+INDEX_VERSION = 2
+
+# path: source clip
+# folder: folder it lives in, as used to pick clips (e.g. 'videos/night')
+# fps, frame_count, width, height: of the source
+# loop_start, loop_end: frames to play, end exclusive. The end is the frame
+# near the end that looks most like the start, so loops are less of a jump
+# proxy: copy scaled to the display size, or None
+Clip = namedtuple('Clip', ['path', 'folder', 'fps', 'frame_count', 'width', 'height', 'loop_start', 'loop_end', 'proxy'])
+
+def find_clips(path=VIDEO_DIR):
+    # Returns a dict of folders : filenames, for folders without subfolders
+    videos = {}
+    for root, dirs, files in os.walk(path):
+        # If the directory has files in it
+        if len(dirs) == 0:
+            # Keep only video files
+            videos[root] = sorted(file for file in files if file.endswith(VIDEO_EXTENSIONS))
+    return videos
+
+def thumbnail(frame):
+    small = cv2.resize(frame, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+def proxy_path(path, root=VIDEO_DIR, proxy_dir=PROXY_DIR):
+    # Mirrors the videos folder layout
+    name = os.path.splitext(os.path.relpath(path, root))[0] + PROXY_EXTENSION
+    return os.path.join(proxy_dir, name)
+
+def index_clip(path, folder, root=VIDEO_DIR, proxy_dir=PROXY_DIR, size=PROXY_SIZE):
+    # Decodes the whole clip once, writing the proxy as it goes
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError('Could not open ' + path)
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    proxy = proxy_path(path, root, proxy_dir) if proxy_dir else None
+    writer = None
+    if proxy:
+        os.makedirs(os.path.dirname(proxy), exist_ok=True)
+        writer = cv2.VideoWriter(proxy, cv2.VideoWriter_fourcc(*PROXY_CODEC), fps, size)
+
+    # Container frame counts are often wrong, so count what actually decodes,
+    # and keep thumbnails of the last second to choose the loop point from
+    first = None
+    tail = []
+    frame_count = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        thumb = thumbnail(frame)
+        if first is None:
+            first = thumb
+        tail.append(thumb)
+        tail = tail[-max(int(fps), 1):]
+        frame_count = frame_count + 1
+        if writer is not None:
+            writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+    cap.release()
+    if writer is not None:
+        writer.release()
+
+    if frame_count == 0:
+        raise IOError('No frames in ' + path)
+
+    # Whichever of the last second's frames is closest to the first is replaced
+    # by it, so loop back just before that frame. Short clips only look in
+    # their second half, so they don't loop after a frame or two.
+    tail = tail[len(tail) - min(len(tail), frame_count // 2):]
+    diffs = [np.abs(thumb - first).mean() for thumb in tail]
+    loop_end = frame_count - len(tail) + int(np.argmin(diffs)) if diffs else frame_count
+
+    # The proxy keeps every frame, the player rewinds at loop_end
+    return Clip(path, folder, fps, frame_count, width, height, 0, loop_end, proxy)
+
+def load_index(path):
+    # Returns {path: (entry, source stamp)}, empty if there's no index yet
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if index.get('version') != INDEX_VERSION:
+        return {}
+    return {clip['path']: (Clip(**clip['clip']), clip['stamp']) for clip in index['clips']}
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def build_index(path=VIDEO_DIR, index_path=None, proxy_dir=PROXY_DIR):
+    # Indexes new or changed clips, reusing entries for the rest
+    index_path = index_path or os.path.join(path, 'index.json')
+    old = load_index(index_path)
+    entries = []
+
+    for folder, files in find_clips(path).items():
+        for file in files:
+            clip_path = os.path.join(folder, file)
+            stamp = source_stamp(clip_path)
+            clip, old_stamp = old.get(clip_path, (None, None))
+            if clip is None or old_stamp != stamp or (clip.proxy and not os.path.exists(clip.proxy)):
+                print('indexing ' + clip_path)
+                try:
+                    clip = index_clip(clip_path, folder, path, proxy_dir)
+                except IOError as e:
+                    print('WARNING: ' + str(e))
+                    continue
+            entries.append({'path': clip_path, 'stamp': stamp, 'clip': clip._asdict()})
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'clips': entries}, f, indent=1)
+    os.replace(tmp_path, index_path)
+
+    return len(entries)
+
+def load_library(path=VIDEO_DIR, index_path=None):
+    # Returns a dict of folders : Clips. Uses the index where there is one,
+    # clips it doesn't know about are listed with no metadata and no proxy.
+    index = load_index(index_path or os.path.join(path, 'index.json'))
+    videos = {}
+    for folder, files in find_clips(path).items():
+        clips = []
+        for file in files:
+            clip_path = os.path.join(folder, file)
+            clip = index.get(clip_path, (None,))[0]
+            if clip is None:
+                clip = Clip(clip_path, folder, None, None, None, None, 0, None, None)
+            elif clip.proxy and not os.path.exists(clip.proxy):
+                clip = clip._replace(proxy=None)
+            clips.append(clip)
+        videos[folder] = clips
+    return videos
+
+if __name__ == '__main__':
+    # python library.py [videos folder]
+    count = build_index(*sys.argv[1:2])
+    print('%d clips indexed' % count)
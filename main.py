@@ -1,60 +1,90 @@
-from time import time
+from time import time, sleep
 import mido
 import multiprocessing as mp
-from devices import Devices
+import atexit
+from devices import Devices, AsyncDevices
 from data import load_data, get_start_index
+from timeline import build_timeline, share_timeline, unshare_timeline
 from audio import Audio
 from video import Video
 from sensors import Sensors
-from statistics import median
+from tick import TickBus, STEPS_PER_YEAR
+from clock import TempoTracker, SharedClock, ClockState, PPQN, TICKS_PER_STEP
+from metrics import Metrics, serve_metrics, histogram, counter
+from sensor_state import SensorState
+
+# 'mqtt' publishes straight to zigbee2mqtt, 'platypush' goes through platypush
+DEVICE_BACKEND = 'mqtt'
+
+# Send to independent devices concurrently (asyncio) rather than one by one
+ASYNC_DEVICES = True
 
 class Listener:
-    def __init__(self):
+    def __init__(self, metrics=None):
         self.inport = mido.open_input()
 
-        self.bpm_list = [100, 100, 100, 100, 100]
+        self.tracker = TempoTracker()
+        self.ticks = 0
 
-    def run(self, i, bpm):
+        self.midi_messages = counter(metrics, 'listener.midi_messages')
+        self.tick_jitter = histogram(metrics, 'listener.tick_jitter')
 
-        ticks = 0
+    def on_message(self, msg, arrival_time, i, clock):
+        self.midi_messages.add()
+        if msg.type == 'clock':
+            # Filtered time of this tick
+            tick_time = self.tracker.update(arrival_time)
+            self.tick_jitter.observe(abs(arrival_time - tick_time))
 
-        print('Ready for midi...')
+            if self.ticks % TICKS_PER_STEP == 0:
+                # Loop round at end of day
+                index = (i.value + 1) % STEPS_PER_YEAR
 
-        i_time_last = time()
+                # Publish tempo and position first so woken consumers see them
+                clock.write(ClockState(index, tick_time, self.tracker.period * TICKS_PER_STEP,
+                                       self.tracker.bpm, self.ticks % PPQN))
+                i.publish(index, tick_time)
 
-        for msg in self.inport:
-            if msg.type == 'clock':
-                    if ticks % 6 == 0:
-                        # Loop round at end of day
-                        i.value = (i.value + 1) % 525600
+            self.ticks = self.ticks + 1
 
-                        i_time = time()
-                        raw_bpm = int(4*4/(i_time - i_time_last))
-                        self.bpm_list.insert(0, raw_bpm)
-                        self.bpm_list.pop()
-                        bpm.value = median(self.bpm_list)
-                        i_time_last = i_time
+        elif msg.type == 'start':
+            # Transport restarted, re-align to the beat
+            self.ticks = 0
+            self.tracker.reset()
 
-                    ticks = ticks + 1
+    def run(self, i, clock):
+
+        print('Ready for midi...')
 
-def listener(i, bpm):
-    my_listener = Listener()
-    my_listener.run(i, bpm)
+        # mido doesn't pass on the driver's timestamps, so messages are stamped
+        # the moment they arrive on the MIDI thread rather than when we get round
+        # to reading them
+        self.inport.callback = lambda msg: self.on_message(msg, time(), i, clock)
 
-def devices_loop(i, df, sensor_flags):
-    my_devices = Devices(df)
+        while True:
+            sleep(1)
+
+def listener(i, clock, metrics=None):
+    my_listener = Listener(metrics)
+    my_listener.run(i, clock)
+
+def devices_loop(i, timeline, sensor_flags, metrics=None):
+    if ASYNC_DEVICES:
+        my_devices = AsyncDevices(timeline, backend=DEVICE_BACKEND, metrics=metrics)
+    else:
+        my_devices = Devices(timeline, backend=DEVICE_BACKEND, metrics=metrics)
     my_devices.run(i, sensor_flags)
 
-def audio_loop(i, df, sensor_flags):
-    my_audio = Audio(df)
+def audio_loop(i, clock, timeline, sensor_flags, metrics=None):
+    my_audio = Audio(timeline, clock=clock, metrics=metrics)
     my_audio.run(i, sensor_flags)
 
-def video_loop(i, bpm, df):
-    my_video = Video(df, use_redis=True)
-    my_video.run(i, bpm)
+def video_loop(i, clock, timeline, metrics=None):
+    my_video = Video(timeline, use_redis=True, metrics=metrics)
+    my_video.run(i, clock)
 
-def sensors_loop(sensor_flags):
-    my_sensors = Sensors()
+def sensors_loop(sensor_flags, metrics=None):
+    my_sensors = Sensors(metrics)
     my_sensors.run(sensor_flags)
 
 if __name__ == "__main__":
@@ -63,24 +93,29 @@ if __name__ == "__main__":
 
     df = load_data(cached=True)
 
-    i = mp.Value('i', get_start_index(df))
-    bpm = mp.Value('i', 0)
+    # Publish the timeline once, child processes map it by name
+    timeline = share_timeline(build_timeline(df))
+    atexit.register(unshare_timeline, timeline)
+
+    i = TickBus(get_start_index(df))
+    clock = SharedClock(i.value)
+
+    # Every process records into this, served from here (see metrics.py)
+    metrics = Metrics()
+    try:
+        serve_metrics(metrics)
+    except OSError as e:
+        print('WARNING: Could not serve metrics (' + str(e) + ')')
     
-    s1 = mp.Value('b', False)
-    s2 = mp.Value('b', False)
-    s3 = mp.Value('b', False)
-    s4 = mp.Value('b', False)
-    s5 = mp.Value('b', False)
-    s6 = mp.Value('b', False)
-
-    sensor_flags = [s1, s2, s3, s4, s5, s6]
+    # Every sensor's on/off in one shared word, written by Sensors once debounced
+    sensor_flags = SensorState()
     # sensor_flags = None
     
-    p1 = mp.Process(target=listener, args=(i, bpm))
-    p2 = mp.Process(target=devices_loop, args=(i, df, sensor_flags))
-    p3 = mp.Process(target=audio_loop, args=(i, df, sensor_flags))
-    # p4 = mp.Process(target=video_loop, args=(i, bpm, df))
-    p5 = mp.Process(target=sensors_loop, args=(sensor_flags,))
+    p1 = mp.Process(target=listener, args=(i, clock, metrics))
+    p2 = mp.Process(target=devices_loop, args=(i, timeline, sensor_flags, metrics))
+    p3 = mp.Process(target=audio_loop, args=(i, clock, timeline, sensor_flags, metrics))
+    # p4 = mp.Process(target=video_loop, args=(i, clock, timeline, metrics))
+    p5 = mp.Process(target=sensors_loop, args=(sensor_flags, metrics))
 
     p1.start()
     p2.start()
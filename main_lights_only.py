@@ -1,18 +1,27 @@
 from time import sleep
 import multiprocessing as mp
-from devices import Devices
+import atexit
+from devices import Devices, AsyncDevices
 from data import load_data, get_start_index
+from timeline import build_timeline, share_timeline, unshare_timeline
+from tick import TickBus
 
 BPM = 100
 
+# 'mqtt' publishes straight to zigbee2mqtt, 'platypush' goes through platypush
+DEVICE_BACKEND = 'mqtt'
+
+# Send to independent devices concurrently (asyncio) rather than one by one
+ASYNC_DEVICES = True
+
 class Clock:
     def __init__(self):
         return
     
     def run(self, i):
         while True:
-            # Loop round at end of day
-            i.value = (i.value + 1) % 525600
+            # Loop round at end of day and wake consumers
+            i.advance()
 
             # print(i.value)
 
@@ -23,8 +32,11 @@ def clock_loop(i):
     my_clock = Clock()
     my_clock.run(i)
 
-def devices_loop(i, df, sensor_flags):
-    my_devices = Devices(df)
+def devices_loop(i, timeline, sensor_flags):
+    if ASYNC_DEVICES:
+        my_devices = AsyncDevices(timeline, backend=DEVICE_BACKEND)
+    else:
+        my_devices = Devices(timeline, backend=DEVICE_BACKEND)
     my_devices.run(i, sensor_flags)
 
 if __name__ == "__main__":
@@ -33,12 +45,16 @@ if __name__ == "__main__":
 
     df = load_data(cached=True)
 
-    i = mp.Value('i', get_start_index(df))
+    # Publish the timeline once, child processes map it by name
+    timeline = share_timeline(build_timeline(df))
+    atexit.register(unshare_timeline, timeline)
+
+    i = TickBus(get_start_index(df))
 
     sensor_flags = None
     
     p1 = mp.Process(target=clock_loop, args=(i,))
-    p2 = mp.Process(target=devices_loop, args=(i, df, sensor_flags))
+    p2 = mp.Process(target=devices_loop, args=(i, timeline, sensor_flags))
 
     p1.start()
     p2.start()
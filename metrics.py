@@ -0,0 +1,194 @@
+import json
+import threading
+import multiprocessing as mp
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import time, sleep
+
+# Live metrics for every process main.py starts. Everything lives in one
+# shared array of plain integers, set up before the processes start. Each
+# metric is only written from one process, so there are no locks: recording
+# is a couple of integer adds. Threads within a process can very occasionally
+# lose an increment to each other, which is fine for monitoring.
+# Read them with: curl http://127.0.0.1:8090/metrics
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 8090
+
+# Histogram bucket k counts values under 2**k microseconds (bucket 0 is
+# zero), so 25 buckets cover up to about 17 seconds
+N_BUCKETS = 25
+
+# Rates are worked out over this many seconds
+RATE_WINDOW = 10
+
+HISTOGRAM = 'histogram'
+COUNTER = 'counter'
+
+# Every metric, named for the process that writes it
+METRICS = {
+    'listener.tick_jitter': HISTOGRAM,      # MIDI clock tick arrival vs filtered time
+    'listener.midi_messages': COUNTER,      # MIDI messages in
+    'devices.step_lag': HISTOGRAM,          # step published to Devices seeing it
+    'devices.send_latency': HISTOGRAM,      # one Zigbee message
+    'devices.step_latency': HISTOGRAM,      # step published to all its messages done
+    'devices.messages': COUNTER,            # Zigbee messages sent
+    'devices.send_failures': COUNTER,
+    'audio.step_lag': HISTOGRAM,            # step published to Audio seeing it
+    'audio.event_lateness': HISTOGRAM,      # scheduled MIDI event vs its target time
+    'audio.midi_messages': COUNTER,         # MIDI messages out
+    'video.frame_time': HISTOGRAM,          # between frames shown
+    'video.frames_shown': COUNTER,
+    'video.frames_late': COUNTER,
+    'video.frames_skipped': COUNTER,        # source frames the decoder stepped over to catch up
+    'video.frames_dropped': COUNTER,        # frames the display threw away as too late
+    'video.frames_duplicated': COUNTER,
+    'sensors.messages': COUNTER,
+}
+
+class Histogram:
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    def observe(self, seconds):
+        us = max(int(seconds * 1000000), 0)
+        offset = self.offset
+        self.array[offset + min(us.bit_length(), N_BUCKETS - 1)] += 1
+        self.array[offset + N_BUCKETS] += 1
+        self.array[offset + N_BUCKETS + 1] += us
+
+class Counter:
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    def add(self, n=1):
+        self.array[self.offset] += n
+
+class NullMetric:
+    # Stands in for either kind when there's no Metrics
+    def observe(self, seconds):
+        return
+
+    def add(self, n=1):
+        return
+
+NULL_METRIC = NullMetric()
+
+def histogram(metrics, name):
+    # The named histogram, or a no-op if metrics is None
+    return metrics.histogram(name) if metrics is not None else NULL_METRIC
+
+def counter(metrics, name):
+    return metrics.counter(name) if metrics is not None else NULL_METRIC
+
+class Metrics:
+    def __init__(self, metrics=METRICS):
+        self.kinds = dict(metrics)
+        self.offsets = {}
+        size = 0
+        for name, kind in self.kinds.items():
+            self.offsets[name] = size
+            # Histograms hold their buckets, then a count and a sum in microseconds
+            size = size + (N_BUCKETS + 2 if kind == HISTOGRAM else 1)
+        self.array = mp.RawArray('Q', size)
+        self.start_time = time()
+
+    def histogram(self, name):
+        if self.kinds[name] != HISTOGRAM:
+            raise KeyError(name + ' is not a histogram')
+        return Histogram(self.array, self.offsets[name])
+
+    def counter(self, name):
+        if self.kinds[name] != COUNTER:
+            raise KeyError(name + ' is not a counter')
+        return Counter(self.array, self.offsets[name])
+
+    def snapshot(self):
+        # Raw values by name: counts for counters, (buckets, count, sum) for histograms
+        values = self.array[:]
+        snapshot = {}
+        for name, kind in self.kinds.items():
+            offset = self.offsets[name]
+            if kind == HISTOGRAM:
+                snapshot[name] = (values[offset:offset + N_BUCKETS], values[offset + N_BUCKETS], values[offset + N_BUCKETS + 1])
+            else:
+                snapshot[name] = values[offset]
+        return snapshot
+
+def percentile(buckets, count, p):
+    # Upper bound of the bucket the p'th percentile falls in, in ms
+    target = count * p / 100
+    total = 0
+    for k, n in enumerate(buckets):
+        total = total + n
+        if total >= target:
+            return (2 ** k) / 1000 if k else 0
+    return (2 ** (len(buckets) - 1)) / 1000
+
+def summarise(snapshot, rates):
+    summary = {}
+    for name, value in snapshot.items():
+        if isinstance(value, tuple):
+            buckets, count, total = value
+            summary[name] = {
+                'count': count,
+                'mean_ms': round(total / count / 1000, 3) if count else None,
+                'p50_ms': percentile(buckets, count, 50) if count else None,
+                'p90_ms': percentile(buckets, count, 90) if count else None,
+                'p99_ms': percentile(buckets, count, 99) if count else None,
+            }
+        else:
+            summary[name] = {'total': value, 'per_second': rates.get(name)}
+    return summary
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, address):
+        super().__init__(address, MetricsHandler)
+        self.metrics = metrics
+
+        # Counter samples once a second, for rates over the last RATE_WINDOW seconds
+        self.samples = deque(maxlen=RATE_WINDOW + 1)
+
+    def sample(self):
+        while True:
+            self.samples.append((time(), self.metrics.snapshot()))
+            sleep(1)
+
+    def rates(self):
+        if len(self.samples) < 2:
+            return {}
+        (t0, first), (t1, last) = self.samples[0], self.samples[-1]
+        return {name: round((last[name] - first[name]) / (t1 - t0), 2)
+                for name, kind in self.metrics.kinds.items() if kind == COUNTER}
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+
+        summary = summarise(self.server.metrics.snapshot(), self.server.rates())
+        summary['uptime'] = round(time() - self.server.metrics.start_time, 1)
+        body = json.dumps(summary, indent=1).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep requests out of the installation's output
+        return
+
+def serve_metrics(metrics, host=METRICS_HOST, port=METRICS_PORT):
+    # Serves /metrics as JSON from background threads of the calling process
+    server = MetricsServer(metrics, (host, port))
+    threading.Thread(target=server.sample, name='metrics-sample', daemon=True).start()
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
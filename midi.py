@@ -1,28 +1,111 @@
 import mido
 import time
+import threading
+from contextlib import contextmanager
+from metrics import counter
+
+PORT_NAME = 'IAC Driver creatures'
 
 class MidiController:
-    def __init__(self):
-        self.outport = mido.open_output('IAC Driver creatures')
+    def __init__(self, metrics=None):
+        self.outport = mido.open_output(PORT_NAME)
+        self.messages = counter(metrics, 'audio.midi_messages')
+
+        # Mirror of the last value sent for each (channel, control)
+        self.cc_state = {}
+
+        # Messages can come from the scheduler thread as well as the caller's
+        self.lock = threading.RLock()
+
+        # Controls set inside a batch, sent when the batch closes. Kept per
+        # thread so one thread's batch doesn't hold up another's messages.
+        self.local = threading.local()
+
+    def send(self, msg):
+        # Callers hold the lock. Returns False if it didn't go out.
+        try:
+            self.outport.send(msg)
+        except Exception as e:
+            print('WARNING: MIDI send failed (' + str(e) + '), reopening ' + PORT_NAME)
+            if not self.reconnect():
+                return False
+            try:
+                self.outport.send(msg)
+            except Exception as e:
+                print('WARNING: MIDI send failed again after reopening (' + str(e) + ')')
+                return False
+        self.messages.add()
+        return True
+
+    def reconnect(self):
+        # Whatever was sent before may not have arrived, so every control
+        # is resent the next time it's set
+        self.forget_controls()
+        try:
+            self.outport.close()
+        except Exception:
+            pass
+        try:
+            self.outport = mido.open_output(PORT_NAME)
+        except Exception as e:
+            print('WARNING: Could not reopen ' + PORT_NAME + ' (' + str(e) + ')')
+            return False
+        return True
 
     def play_note(self, channel=0, note=60, velocity=64):
-        msg = mido.Message('note_on', channel=channel, note=note, velocity=velocity)
-        self.outport.send(msg)
+        with self.lock:
+            msg = mido.Message('note_on', channel=channel, note=note, velocity=velocity)
+            self.send(msg)
 
-        msg = mido.Message('note_off', channel=channel, note=note, velocity=velocity)
-        self.outport.send(msg)
+            msg = mido.Message('note_off', channel=channel, note=note, velocity=velocity)
+            self.send(msg)
 
-    def set_control(self, channel=0, control=0, value=127):
-        msg = mido.Message('control_change', channel=channel, control=control, value=value)
-        self.outport.send(msg)
+    def send_control(self, channel, control, value):
+        with self.lock:
+            msg = mido.Message('control_change', channel=channel, control=control, value=value)
+            if self.send(msg):
+                self.cc_state[(channel, control)] = value
         # print("Setting control signal %i to %i" % (control, value))
-  
+
+    def set_control(self, channel=0, control=0, value=127, force=False):
+        # Values Ableton already holds are not resent unless forced
+        if getattr(self.local, 'batch_depth', 0) and not force:
+            self.local.cc_pending[(channel, control)] = value
+        elif force or self.cc_state.get((channel, control)) != value:
+            self.send_control(channel, control, value)
+
+    @contextmanager
+    def batch(self):
+        # Collect set_control calls and send only the net changes in one burst
+        # at the end. Batches can be nested, the outermost one sends.
+        if not getattr(self.local, 'batch_depth', 0):
+            self.local.batch_depth = 0
+            self.local.cc_pending = {}
+        self.local.batch_depth = self.local.batch_depth + 1
+        try:
+            yield self
+        finally:
+            self.local.batch_depth = self.local.batch_depth - 1
+            if self.local.batch_depth == 0:
+                self.flush()
+
+    def flush(self):
+        pending, self.local.cc_pending = self.local.cc_pending, {}
+        with self.lock:
+            for (channel, control), value in pending.items():
+                if self.cc_state.get((channel, control)) != value:
+                    self.send_control(channel, control, value)
+
+    def forget_controls(self):
+        # Ableton's state is unknown (e.g. the set was reloaded), resend everything
+        self.cc_state = {}
+
     def test_control(self, channel=0, control=0, value=None):
         if value != None:
-            self.set_control(channel=channel, control=control, value=value)
+            self.set_control(channel=channel, control=control, value=value, force=True)
         else:
             for value in range(128):
-                self.set_control(channel=channel, control=control, value=value)
+                self.set_control(channel=channel, control=control, value=value, force=True)
 
 if __name__ == "__main__":
     my_controller = MidiController()
@@ -0,0 +1,299 @@
+import queue
+import threading
+import cv2
+import numpy as np
+from time import perf_counter
+from metrics import counter
+
+# Frames buffered between each pair of stages. Kept small so what's on
+# screen doesn't fall far behind the step it was processed for
+RING_SIZE = 3
+
+# How long stage threads block before checking whether they should stop
+POLL_TIMEOUT = 0.1
+
+# Frames shown later than this after their deadline count as late
+LATE_THRESHOLD = 0.004
+
+# Slowest the source is allowed to play, so a stopped clock can't stall the video
+MIN_RATE = 0.1
+
+# Tempo at which clips play at their own frame rate. This was 100 when the
+# tempo came from 16/dt per step, which read 16/15 of the real BPM, so the
+# video keeps the same speed for the same music.
+NORMAL_BPM = 100 * 15/16
+
+class StageStats:
+    # busy: time spent doing the stage's work
+    # wait: time spent blocked on the stage either side of it
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.busy = 0
+        self.wait = 0
+        self.max_busy = 0
+
+    def add(self, busy, wait=0):
+        self.count = self.count + 1
+        self.busy = self.busy + busy
+        self.wait = self.wait + wait
+        self.max_busy = max(self.max_busy, busy)
+
+    def report(self):
+        count = max(self.count, 1)
+        return ('%d frames, busy mean %.2f ms, max %.2f ms, waiting mean %.2f ms' %
+                (self.count, self.busy / count * 1000, self.max_busy * 1000, self.wait / count * 1000))
+
+class FramePacer:
+    # Which source frames to show and when. Source position runs at
+    # fps * bpm / NORMAL_BPM frames a second from an anchor that's moved
+    # whenever the tempo changes, so a change never makes it jump or drift.
+    # Frames are shown at that rate up to max_fps; beyond that the decoder
+    # steps over source frames, a fraction of a frame at a time, grabbing but
+    # not decoding them.
+    def __init__(self, fps, max_fps, bpm=NORMAL_BPM, metrics=None):
+        self.fps = fps
+        self.max_fps = max_fps
+        self.rate = max(fps * bpm/NORMAL_BPM, MIN_RATE)
+        self.lock = threading.Lock()
+
+        # Decoder side, next source position to show
+        self.cursor = 0
+
+        # Display side, set by start()
+        self.anchor_time = None
+        self.anchor_position = 0
+
+        self.shown = 0
+        self.late = 0
+        self.dropped = 0
+        self.duplicated = 0
+
+        # Source frames the decoder steps over to catch up. They were never
+        # decoded, so they're kept apart from the frames the display drops.
+        self.skipped = 0
+        self.frames_skipped = counter(metrics, 'video.frames_skipped')
+
+    @property
+    def started(self):
+        return self.anchor_time is not None
+
+    def start(self, position=0, now=None):
+        # Show `position` now, everything else follows from it
+        with self.lock:
+            self.anchor_time = perf_counter() if now is None else now
+            self.anchor_position = position
+
+    def set_tempo(self, bpm, now=None):
+        rate = max(self.fps * bpm/NORMAL_BPM, MIN_RATE)
+        with self.lock:
+            if rate == self.rate:
+                return
+            if self.anchor_time is not None:
+                now = perf_counter() if now is None else now
+                self.anchor_position = self.anchor_position + (now - self.anchor_time) * self.rate
+                self.anchor_time = now
+            self.rate = rate
+
+    def interval(self):
+        # Time between shown frames
+        return 1 / min(self.rate, self.max_fps)
+
+    def advance(self, now=None):
+        # Decoder: returns the source position of the next frame to show
+        with self.lock:
+            if self.anchor_time is not None:
+                # If we've fallen behind, skip to what's due rather than decoding
+                # frames that will only be late
+                now = perf_counter() if now is None else now
+                due = self.anchor_position + (now - self.anchor_time) * self.rate
+                if due > self.cursor + 1:
+                    self.skipped = self.skipped + int(due - self.cursor)
+                    self.frames_skipped.add(int(due - self.cursor))
+                    self.cursor = due
+
+            position = self.cursor
+            self.cursor = self.cursor + max(1, self.rate / self.max_fps)
+            return position
+
+    def deadline(self, position):
+        # Display: when the frame at `position` should go up (as from perf_counter)
+        with self.lock:
+            return self.anchor_time + (position - self.anchor_position) / self.rate
+
+    # Display: counted under the lock, the same as the decoder's skips
+    def add_duplicated(self):
+        with self.lock:
+            self.duplicated = self.duplicated + 1
+
+    def add_dropped(self):
+        with self.lock:
+            self.dropped = self.dropped + 1
+
+    def report(self):
+        return ('%d frames shown, %d late (>%.0f ms), %d dropped, %d duplicated' %
+                (self.shown, self.late, LATE_THRESHOLD * 1000, self.dropped, self.duplicated))
+
+    def report_skipped(self):
+        return '%d source frames skipped by the decoder' % self.skipped
+
+class FrameRing:
+    # A fixed set of frame buffers handed from one thread to the next. The
+    # producer takes a free slot, fills it and commits it, the consumer gets
+    # it and releases it when done. When every slot is in use the producer
+    # blocks, which is the backpressure.
+    def __init__(self, size=RING_SIZE, shape=None, dtype=np.uint8):
+        # Without a shape the buffers are left for the producer to allocate on first use
+        self.frames = [np.empty(shape, dtype) if shape else None for _ in range(size)]
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(size):
+            self.free.put(slot)
+
+    def acquire(self, timeout=None):
+        # Raises queue.Empty if no slot is freed in time
+        return self.free.get(timeout=timeout)
+
+    def commit(self, slot, position):
+        self.ready.put((slot, position))
+
+    def get(self, timeout=None):
+        # Raises queue.Empty if nothing is ready in time
+        return self.ready.get(timeout=timeout)
+
+    def release(self, slot):
+        self.free.put(slot)
+
+class FramePipeline:
+    # Decoder thread -> effects thread -> display (the caller), so decoding,
+    # processing and showing a frame all overlap.
+    # process(frame, n, dst) renders a decoded frame into dst
+    # pacer: a FramePacer, picks the frames to decode
+    # loop_end: frame to rewind at, otherwise the end of the video
+    def __init__(self, cap, process, shape, pacer, loop_end=None, ring_size=RING_SIZE):
+        self.cap = cap
+        self.process = process
+        self.pacer = pacer
+        self.loop_end = loop_end
+
+        self.decoded = FrameRing(ring_size)
+        self.processed = FrameRing(ring_size, shape)
+
+        self.stats = {'decode': StageStats(), 'effects': StageStats(), 'display': StageStats()}
+        self.running = False
+        self.error = None
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self.guard, args=(self.decode,), name='video-decode', daemon=True),
+            threading.Thread(target=self.guard, args=(self.effects,), name='video-effects', daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+    def report(self):
+        for name, stats in self.stats.items():
+            print(name + ': ' + stats.report())
+        print('pacing: ' + self.pacer.report())
+        print('catching up: ' + self.pacer.report_skipped())
+
+    def guard(self, stage):
+        # A dead stage would otherwise leave the display waiting forever
+        try:
+            stage()
+        except Exception as e:
+            print('WARNING: Video pipeline stage failed (' + str(e) + ')')
+            self.error = e
+            self.running = False
+
+    def acquire(self, ring):
+        # Block for a free slot, giving up if we're stopped meanwhile
+        while self.running:
+            try:
+                return ring.acquire(POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+        return None
+
+    def decode(self):
+        # Source frames grabbed so far, and how far into the clip we are
+        played = 0
+        clip_frame = 0
+        while self.running:
+            wait_start = perf_counter()
+            slot = self.acquire(self.decoded)
+            if slot is None:
+                return
+            start = perf_counter()
+
+            # Grab is cheap, only decode the frames we'll show
+            position = self.pacer.advance()
+            n = int(position)
+            while self.running and played <= n:
+                if (self.loop_end is None or clip_frame < self.loop_end) and self.cap.grab():
+                    played = played + 1
+                    clip_frame = clip_frame + 1
+                elif clip_frame == 0:
+                    # Nothing since the last rewind, so rewinding again won't help
+                    raise RuntimeError('No frames could be read from the video')
+                else:
+                    print('returning to start of video')
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    clip_frame = 0
+            if not self.running:
+                return
+
+            ret, frame = self.cap.retrieve(self.decoded.frames[slot])
+            if not ret:
+                self.decoded.release(slot)
+                continue
+            self.decoded.frames[slot] = frame
+            self.decoded.commit(slot, position)
+
+            self.stats['decode'].add(perf_counter() - start, start - wait_start)
+
+    def effects(self):
+        while self.running:
+            wait_start = perf_counter()
+            try:
+                slot_in, position = self.decoded.get(POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+            slot_out = self.acquire(self.processed)
+            if slot_out is None:
+                return
+            start = perf_counter()
+
+            self.process(self.decoded.frames[slot_in], int(position), self.processed.frames[slot_out])
+            self.decoded.release(slot_in)
+            self.processed.commit(slot_out, position)
+
+            self.stats['effects'].add(perf_counter() - start, start - wait_start)
+
+    def get(self, timeout=None):
+        # Next processed frame as (slot, source position, frame), or None if
+        # none is ready in time. The slot must be handed back with release()
+        # once the frame is shown.
+        if self.error is not None:
+            raise self.error
+        try:
+            slot, position = self.processed.get(timeout)
+        except queue.Empty:
+            return None
+        return slot, position, self.processed.frames[slot]
+
+    def release(self, slot):
+        self.processed.release(slot)
+
+    def waiting(self):
+        # Processed frames ready behind the one being shown
+        return self.processed.ready.qsize()
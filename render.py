@@ -0,0 +1,63 @@
+import argparse
+import os
+from collections import defaultdict
+from time import perf_counter
+from data import load_data, get_start_index
+from timeline import build_timeline
+from clock import SyntheticClock
+from library import load_library, Clip
+from sinks import NullSink, SharedFrameSink, FileSink
+from video import Video
+
+# Renders Video headless from a synthetic clock, e.g.
+#   python render.py --clip videos/night/stars.mp4 --sink null --seconds 30
+#   python render.py --sink file --output clock.avi --speed 50
+# and reports sustained fps and per stage timings
+
+def make_sink(name, width, height, output=None):
+    if name == 'null':
+        return NullSink()
+    elif name == 'shm':
+        return SharedFrameSink(width, height)
+    elif name == 'file':
+        return FileSink(output or 'render.avi', width, height)
+    raise ValueError('Unknown sink ' + name)
+
+def clip_library(path):
+    # Every folder plays the given clip, using its index entry if it has one
+    for clips in load_library().values():
+        for clip in clips:
+            if os.path.normpath(clip.path) == os.path.normpath(path):
+                return defaultdict(lambda: [clip])
+    clip = Clip(path, os.path.dirname(path), None, None, None, None, 0, None, None)
+    return defaultdict(lambda: [clip])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the clock video without a display')
+    parser.add_argument('--clip', help='play just this clip rather than the library')
+    parser.add_argument('--width', type=int, default=800)
+    parser.add_argument('--height', type=int, default=600)
+    parser.add_argument('--sink', choices=['null', 'shm', 'file'], default='null')
+    parser.add_argument('--output', help='file to encode to, for --sink file')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--bpm', type=float, default=100)
+    parser.add_argument('--speed', type=float, default=1, help='steps go by this many times faster')
+    parser.add_argument('--unpaced', action='store_true', help='render as fast as possible')
+    args = parser.parse_args()
+
+    df = load_data(cached=True)
+    timeline = build_timeline(df)
+    clock = SyntheticClock(get_start_index(df), bpm=args.bpm, speed=args.speed)
+
+    videos = clip_library(args.clip) if args.clip else None
+    video = Video(timeline, width=args.width, height=args.height, videos=videos)
+    if args.unpaced:
+        video.max_fps = 1000
+
+    sink = make_sink(args.sink, args.width, args.height, args.output)
+
+    start = perf_counter()
+    video.run(clock, clock, sink=sink, duration=args.seconds, paced=not args.unpaced)
+    elapsed = perf_counter() - start
+
+    print('%d frames in %.1f s, %.1f fps sustained at %dx%d' % (sink.frames, elapsed, sink.frames / elapsed, args.width, args.height))
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import os
+import threading
+from time import time, sleep
+from metrics import histogram
+
+STEPS_PER_YEAR = 525600
+
+# Steps per beat at 24 ppqn with a step every 6 clock ticks
+STEPS_PER_BEAT = 4
+
+# How many steps ahead Audio queues events
+LOOKAHEAD_STEPS = 2
+
+# The last stretch before an event is spun rather than slept, sleep is too coarse
+SPIN_TIME = 0.002
+
+# Events dispatched later than this count as late
+LATE_THRESHOLD = 0.002
+
+class BeatClock:
+    # Predicts when a step will happen from the steps seen so far
+    def __init__(self, bpm=100, smoothing=0.2):
+        self.period = 60 / bpm / STEPS_PER_BEAT
+        self.smoothing = smoothing
+        self.index = None
+        self.timestamp = None
+
+    def sync(self, index, timestamp):
+        if self.index is not None:
+            steps = (index - self.index) % STEPS_PER_YEAR
+            if steps > 0 and timestamp > self.timestamp:
+                period = (timestamp - self.timestamp) / steps
+                self.period = self.period + self.smoothing * (period - self.period)
+        self.index = index
+        self.timestamp = timestamp
+
+    def time_of(self, index):
+        # Expected time of a (future) step
+        if self.index is None:
+            return time()
+        steps = (index - self.index) % STEPS_PER_YEAR
+        if steps > STEPS_PER_YEAR // 2:
+            # Already behind us
+            steps = steps - STEPS_PER_YEAR
+        return self.timestamp + steps * self.period
+
+class LateStats:
+    def __init__(self, threshold=LATE_THRESHOLD):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.late = 0
+        self.total_lateness = 0
+        self.max_lateness = 0
+
+    def add(self, lateness):
+        self.count = self.count + 1
+        self.total_lateness = self.total_lateness + lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > self.threshold:
+            self.late = self.late + 1
+
+    def report(self):
+        mean = self.total_lateness / self.count if self.count else 0
+        return ('%d events, %d late (>%.1f ms), mean %.2f ms, max %.2f ms' %
+                (self.count, self.late, self.threshold * 1000, mean * 1000, self.max_lateness * 1000))
+
+class MidiScheduler:
+    # Runs queued callables at their target times from its own thread
+    def __init__(self, late_threshold=LATE_THRESHOLD, metrics=None):
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stats = LateStats(late_threshold)
+        self.lateness = histogram(metrics, 'audio.event_lateness')
+        self.thread = None
+
+    def start(self):
+        # Runs for the life of the process
+        self.thread = threading.Thread(target=self.run, name='midi-scheduler', daemon=True)
+        self.thread.start()
+
+    def at(self, when, fn, *args):
+        # Run fn(*args) at time `when` (as from time.time())
+        with self.condition:
+            heapq.heappush(self.queue, (when, next(self.counter), fn, args))
+            self.condition.notify()
+
+    def raise_priority(self):
+        # Real time scheduling where the OS lets us, otherwise carry on as we are
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        except (AttributeError, OSError):
+            try:
+                os.nice(-10)
+            except (AttributeError, OSError):
+                pass
+
+    def run(self):
+        self.raise_priority()
+
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] - time() > SPIN_TIME:
+                    timeout = self.queue[0][0] - time() - SPIN_TIME if self.queue else None
+                    self.condition.wait(timeout)
+                when, _, fn, args = heapq.heappop(self.queue)
+
+            # Spin out the last moment
+            while time() < when:
+                sleep(0)
+
+            lateness = max(0, time() - when)
+            self.stats.add(lateness)
+            self.lateness.observe(lateness)
+            try:
+                fn(*args)
+            except Exception as e:
+                print('WARNING: Scheduled MIDI event failed (' + str(e) + ')')
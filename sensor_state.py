@@ -0,0 +1,39 @@
+import multiprocessing as mp
+from collections import namedtuple
+
+N_SENSORS = 6
+
+# The on/off bit of every sensor sits in the low bits of one shared 64 bit
+# word, with a sequence number above them that goes up on every change. A
+# reader gets every sensor and the sequence number together from a single
+# load, so there's nothing to lock or retry. Only the Sensors process writes.
+SEQ_SHIFT = 16
+SENSOR_MASK = (1 << SEQ_SHIFT) - 1
+
+# seq: changes whenever any sensor does, so readers can tell nothing moved
+# flags: on/off of each sensor, sensor 1 first
+SensorSnapshot = namedtuple('SensorSnapshot', ['seq', 'flags'])
+
+class SensorState:
+    def __init__(self, n_sensors=N_SENSORS):
+        if n_sensors > SEQ_SHIFT:
+            raise ValueError('At most ' + str(SEQ_SHIFT) + ' sensors')
+        self.n_sensors = n_sensors
+        self.word = mp.RawValue('Q', 0)
+
+    def __len__(self):
+        return self.n_sensors
+
+    def read(self):
+        word = self.word.value
+        return SensorSnapshot(word >> SEQ_SHIFT, tuple(bool(word >> s & 1) for s in range(self.n_sensors)))
+
+    def set(self, sensor, on):
+        # Sensors numbered from 0. Returns True if it changed.
+        word = self.word.value
+        bits = word & SENSOR_MASK
+        new_bits = bits | (1 << sensor) if on else bits & ~(1 << sensor)
+        if new_bits == bits:
+            return False
+        self.word.value = ((word >> SEQ_SHIFT) + 1) << SEQ_SHIFT | new_bits
+        return True
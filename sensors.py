@@ -1,12 +1,49 @@
 from urllib.parse import urlparse
 import paho.mqtt.client as mosquitto
 import json
-from time import sleep
-import multiprocessing as mp
+from time import sleep, monotonic
+from metrics import counter
+from sensor_state import SensorState, N_SENSORS
+
+# Contacts chatter, flapping a few tenths of a second apart as people shift
+# about. A new reading only goes downstream once it has held this long, so a
+# burst of flaps is one change (or none, if it ends where it started).
+# Going off takes longer than coming on so fidgeting doesn't cut the sound.
+DEBOUNCE_ON = 0.75
+DEBOUNCE_OFF = 1.5
+
+# Longest the network loop blocks, and so how late a settled reading can be
+POLL_INTERVAL = 0.05
+
+class SensorDebounce:
+    # One sensor's raw readings, and the state they've settled on
+    def __init__(self, on_time=DEBOUNCE_ON, off_time=DEBOUNCE_OFF):
+        self.on_time = on_time
+        self.off_time = off_time
+        self.reading = False
+        self.since = monotonic()
+        self.state = False
+
+    def update(self, reading, now):
+        if reading != self.reading:
+            self.reading = reading
+            self.since = now
+
+    def settle(self, now):
+        # Returns True if the reading has held long enough to become the state
+        if self.reading == self.state:
+            return False
+        if now - self.since < (self.on_time if self.reading else self.off_time):
+            return False
+        self.state = self.reading
+        return True
 
 # Define event callbacks
 class Sensors:
-    def __init__(self):
+    # debounce: {sensor number: (on time, off time)} for sensors that need
+    # their own settings, the rest use DEBOUNCE_ON and DEBOUNCE_OFF
+    def __init__(self, metrics=None, debounce=None):
+        self.messages = counter(metrics, 'sensors.messages')
         self.url_str = 'mqtt://localhost:1883'
         self.sensor_names = [('zigbee2mqtt/Sensor 1', 0),
                              ('zigbee2mqtt/Sensor 2', 0),
@@ -15,19 +52,31 @@ class Sensors:
                              ('zigbee2mqtt/Sensor 5', 0),
                              ('zigbee2mqtt/Sensor 6', 0)]
 
+        debounce = debounce or {}
+        self.debounce = [SensorDebounce(*debounce.get(s+1, (DEBOUNCE_ON, DEBOUNCE_OFF))) for s in range(N_SENSORS)]
+
     def on_connect(self, mosq, obj, flag, rc):
         print("rc: " + str(rc))
 
     def on_message(self, mosq, sensor_flags, msg):
         # print(msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
+        self.messages.add()
         response = json.loads(msg.payload)
         sensor_id = int(msg.topic[-1])
 
-        print('sensor ' + str(sensor_id) + ' is ' + str(response['contact']))
+        # Passed on once it settles
+        self.debounce[sensor_id-1].update(bool(response['contact']), monotonic())
+        self.settle(sensor_flags)
+
+    def settle(self, sensor_flags):
+        now = monotonic()
+        for s, debounce in enumerate(self.debounce):
+            if debounce.settle(now):
+                print('sensor ' + str(s+1) + ' is ' + str(debounce.state))
 
-        # Set sensor flag to response (true/false)
-        if sensor_flags is not None:
-            sensor_flags[sensor_id-1].value = response['contact']
+                # Set sensor flag to the settled state (true/false)
+                if sensor_flags is not None:
+                    sensor_flags.set(s, debounce.state)
 
     def on_publish(self, mosq, obj, mid):
         # print("Publish: " + str(mid))
@@ -68,20 +117,15 @@ class Sensors:
         # mqttc.publish("hello/world", "my message")
 
         # Continue the network loop, exit when an error occurs
+        # and settle readings in between
         rc = 0
         while rc == 0:
-            rc = mqttc.loop()
+            rc = mqttc.loop(timeout=POLL_INTERVAL)
+            self.settle(sensors)
         print("rc: " + str(rc))
 
 if __name__ == "__main__":
-    s1 = mp.Value('b', False)
-    s2 = mp.Value('b', False)
-    s3 = mp.Value('b', False)
-    s4 = mp.Value('b', False)
-    s5 = mp.Value('b', False)
-    s6 = mp.Value('b', False)
-
-    sensor_flags = [s1, s2, s3, s4, s5, s6]
+    sensor_flags = SensorState()
 
     my_sensors = Sensors()
     my_sensors.run(sensor_flags)
\ No newline at end of file
@@ -0,0 +1,241 @@
+import argparse
+import bisect
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import threading
+import numpy as np
+from datetime import datetime
+from random import random, randrange
+from time import sleep, process_time
+from data import load_data, get_start_index
+from timeline import build_timeline, share_timeline, unshare_timeline
+from tick import TickBus
+from clock import SharedClock
+from metrics import Metrics, summarise as summarise_metrics
+from sensor_state import SensorState
+
+# Runs main.py's processes end to end against in-process stand-ins (fakes.py)
+# for the MIDI ports, the MQTT broker and platypush, driven by a synthetic MIDI
+# clock, and reports tick to output latency, messages per step and CPU per
+# process, along with the processes' own metrics (metrics.py). Each run is
+# appended to RESULTS_PATH tagged with the commit, e.g.
+#   python simulate.py --bpm 120 --seconds 30
+
+RESULTS_PATH = 'simulation_results.jsonl'
+
+# Outputs this far ahead of a step still count towards it (audio is scheduled
+# to land on the step, so can be a touch early)
+EARLY_TOLERANCE = 0.01
+
+PERCENTILES = [50, 90, 99]
+
+### PROCESSES ###
+
+# Each runs the real loop on its main thread, as main.py does, while another
+# thread waits `seconds` then puts (name, cpu seconds, output times) on
+# `results` and ends the process
+
+def report_after(name, results, seconds, outputs):
+    cpu_start = process_time()
+
+    def report():
+        sleep(seconds)
+        results.put((name, process_time() - cpu_start, outputs()))
+        results.close()
+        results.join_thread()
+        os._exit(0)
+
+    threading.Thread(target=report, daemon=True).start()
+
+def sim_listener(results, seconds, bpm, jitter, i, clock, metrics):
+    from fakes import FakeMidiPort, FakeMqttBroker, SyntheticMidiClock, install_midi, install_mqtt
+    port = FakeMidiPort('IAC Driver creatures')
+    install_midi(port)
+
+    # main imports everything, which needs the MQTT fakes in place too
+    install_mqtt(FakeMqttBroker())
+    from main import Listener
+
+    # The listener's outputs are the step times everything else is measured from
+    midi_clock = SyntheticMidiClock(port, bpm=bpm, jitter=jitter)
+    report_after('listener', results, seconds, lambda: list(midi_clock.step_times))
+
+    listener = Listener(metrics)
+    threading.Timer(0.1, midi_clock.start).start()
+    listener.run(i, clock)
+
+def sim_devices(results, seconds, i, timeline, sensor_flags, backend, async_devices, metrics):
+    from fakes import FakeMqttBroker, install_mqtt
+    broker = FakeMqttBroker()
+    install_mqtt(broker)
+    from devices import Devices, AsyncDevices
+
+    outputs = lambda: [msg.timestamp for msg in broker.messages_for('zigbee2mqtt/#')]
+    report_after('devices', results, seconds, outputs)
+
+    if async_devices:
+        devices = AsyncDevices(timeline, backend=backend, metrics=metrics)
+    else:
+        devices = Devices(timeline, backend=backend, metrics=metrics)
+    devices.run(i, sensor_flags)
+
+def sim_audio(results, seconds, i, clock, timeline, sensor_flags, metrics):
+    from fakes import FakeMidiPort, install_midi
+    port = FakeMidiPort('IAC Driver creatures')
+    install_midi(port)
+    from audio import Audio
+
+    report_after('audio', results, seconds, port.sent_times)
+
+    audio = Audio(timeline, clock=clock, metrics=metrics)
+    audio.run(i, sensor_flags)
+
+def sim_sensors(results, seconds, sensor_flags, sensor_rate, metrics):
+    from fakes import FakeMqttBroker, install_mqtt
+    broker = FakeMqttBroker()
+    install_mqtt(broker)
+    from sensors import Sensors
+
+    report_after('sensors', results, seconds, lambda: [])
+
+    # People sitting down and getting up, `sensor_rate` changes a second overall
+    def visitors():
+        while True:
+            sleep(np.random.exponential(1 / sensor_rate))
+            sensor = randrange(6) + 1
+            payload = json.dumps({'contact': random() < 0.5})
+            broker.publish('zigbee2mqtt/Sensor ' + str(sensor), payload)
+    if sensor_rate > 0:
+        threading.Thread(target=visitors, daemon=True).start()
+
+    Sensors(metrics).run(sensor_flags)
+
+### REPORT ###
+
+def step_latencies(step_times, output_times):
+    # Per step: time from the step to its first output, and how many outputs it had
+    counts = np.zeros(len(step_times), dtype=int)
+    firsts = np.full(len(step_times), np.nan)
+    for t in sorted(output_times):
+        k = bisect.bisect_right(step_times, t + EARLY_TOLERANCE) - 1
+        if k < 0 or k >= len(step_times):
+            continue
+        counts[k] = counts[k] + 1
+        if np.isnan(firsts[k]):
+            firsts[k] = t - step_times[k]
+    return firsts, counts
+
+def summarise(step_times, outputs, cpu, seconds):
+    report = {'steps': len(step_times)}
+    for name, times in outputs.items():
+        entry = {'cpu_percent': round(100 * cpu[name] / seconds, 1)}
+        if name not in ('listener', 'sensors') and len(step_times) > 1:
+            # Last step is cut short by the end of the run
+            firsts, counts = step_latencies(step_times[:-1], times)
+            firsts = firsts[~np.isnan(firsts)]
+            entry['messages'] = int(counts.sum())
+            entry['messages_per_step'] = round(float(counts.mean()), 2)
+            entry['steps_with_output'] = len(firsts)
+            if len(firsts):
+                for p in PERCENTILES:
+                    entry['latency_p%d_ms' % p] = round(float(np.percentile(firsts, p)) * 1000, 2)
+                entry['latency_max_ms'] = round(float(firsts.max()) * 1000, 2)
+        report[name] = entry
+    return report
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(report):
+    print('commit %s, %d steps at %s bpm over %s s' % (report['commit'], report['steps'], report['bpm'], report['seconds']))
+    for name in ['listener', 'devices', 'audio', 'sensors']:
+        entry = report.get(name)
+        if entry is None:
+            continue
+        line = '%-9s cpu %5.1f%%' % (name, entry['cpu_percent'])
+        if 'messages_per_step' in entry:
+            line = line + '   %5.2f msgs/step' % entry['messages_per_step']
+        if 'latency_p50_ms' in entry:
+            line = line + '   latency ' + ', '.join('p%d %.2f' % (p, entry['latency_p%d_ms' % p]) for p in PERCENTILES)
+            line = line + ', max %.2f ms' % entry['latency_max_ms']
+        print(line)
+
+### RUN ###
+
+def run_simulation(bpm=120, seconds=20, jitter=0.0005, sensor_rate=0.5, backend='mqtt', async_devices=True, results_path=RESULTS_PATH):
+    # Same process layout and start method as main.py, unless the caller already chose one
+    if mp.get_start_method(allow_none=True) is None:
+        mp.set_start_method('forkserver')
+
+    df = load_data(cached=True)
+    timeline = share_timeline(build_timeline(df), name='creatures-timeline-sim')
+
+    try:
+        i = TickBus(get_start_index(df))
+        clock = SharedClock(i.value)
+        sensor_flags = SensorState()
+        metrics = Metrics()
+        results = mp.Queue()
+
+        processes = [
+            mp.Process(target=sim_listener, args=(results, seconds, bpm, jitter, i, clock, metrics)),
+            mp.Process(target=sim_devices, args=(results, seconds, i, timeline, sensor_flags, backend, async_devices, metrics)),
+            mp.Process(target=sim_audio, args=(results, seconds, i, clock, timeline, sensor_flags, metrics)),
+            mp.Process(target=sim_sensors, args=(results, seconds, sensor_flags, sensor_rate, metrics)),
+        ]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        outputs = {}
+        cpu = {}
+        for _ in processes:
+            name, cpu_seconds, times = results.get(timeout=seconds + 60)
+            outputs[name] = times
+            cpu[name] = cpu_seconds
+
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    finally:
+        unshare_timeline(timeline)
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'bpm': bpm,
+        'seconds': seconds,
+        'jitter': jitter,
+        'sensor_rate': sensor_rate,
+        'backend': backend,
+        'async_devices': async_devices,
+    }
+    report.update(summarise(outputs['listener'], outputs, cpu, seconds))
+    report['metrics'] = summarise_metrics(metrics.snapshot(), {})
+
+    if results_path:
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End to end simulation with fake MIDI and Zigbee')
+    parser.add_argument('--bpm', type=float, default=120)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--jitter', type=float, default=0.0005, help='MIDI clock jitter in seconds')
+    parser.add_argument('--sensor-rate', type=float, default=0.5, help='sensor changes per second')
+    parser.add_argument('--backend', choices=['mqtt', 'platypush'], default='mqtt')
+    parser.add_argument('--sync-devices', action='store_true', help='use Devices rather than AsyncDevices')
+    parser.add_argument('--output', default=RESULTS_PATH, help='file to append the report to')
+    args = parser.parse_args()
+
+    report = run_simulation(args.bpm, args.seconds, args.jitter, args.sensor_rate, args.backend,
+                            not args.sync_devices, args.output)
+    print_report(report)
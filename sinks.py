@@ -0,0 +1,88 @@
+import os
+import cv2
+import numpy as np
+from timeline import SHARED_DIR
+
+# Where Video's frames end up. show(frame) returns False to stop playing.
+
+class WindowSink:
+    # Fullscreen OpenCV window, Esc stops
+    def __init__(self, window_name='clock'):
+        self.window_name = window_name
+        self.frames = 0
+
+    def show(self, frame):
+        cv2.imshow(self.window_name, frame)
+        cv2.namedWindow(self.window_name, cv2.WINDOW_FULLSCREEN)
+        cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN) #Disable when on large monitor
+        self.frames = self.frames + 1
+
+        k = cv2.waitKey(1)
+        return k != 27    # Esc key to stop
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+class NullSink:
+    # Throws frames away, for measuring everything up to the display
+    def __init__(self):
+        self.frames = 0
+
+    def show(self, frame):
+        self.frames = self.frames + 1
+        return True
+
+    def close(self):
+        return
+
+class SharedFrameSink:
+    # Latest frame in a memory mapped file another process can read. The
+    # first 8 bytes are a sequence number that's odd while a frame is being
+    # written, the same seqlock scheme as SharedClock. See read_shared_frame.
+    def __init__(self, width, height, name='creatures-frame'):
+        self.path = os.path.join(SHARED_DIR, name)
+        self.shape = (height, width, 3)
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(8 + height * width * 3,))
+        self.seq = self.buffer[:8].view(np.uint64)
+        self.frame = self.buffer[8:].reshape(self.shape)
+        self.frames = 0
+
+    def show(self, frame):
+        self.seq[0] = self.seq[0] + 1
+        self.frame[:] = frame
+        self.seq[0] = self.seq[0] + 1
+        self.frames = self.frames + 1
+        return True
+
+    def close(self):
+        del self.frame, self.seq, self.buffer
+        os.remove(self.path)
+
+def read_shared_frame(path, width, height):
+    # Copy of the latest frame written by a SharedFrameSink, and its sequence number
+    buffer = np.memmap(path, dtype=np.uint8, mode='r', shape=(8 + height * width * 3,))
+    seq = buffer[:8].view(np.uint64)
+    while True:
+        before = int(seq[0])
+        if before % 2:
+            continue
+        frame = np.array(buffer[8:].reshape((height, width, 3)))
+        if int(seq[0]) == before:
+            return frame, before // 2
+
+class FileSink:
+    # Encodes frames to a video file, motion JPEG for .avi, otherwise mp4v
+    def __init__(self, path, width, height, fps=40):
+        codec = 'MJPG' if path.endswith('.avi') else 'mp4v'
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+        if not self.writer.isOpened():
+            raise IOError('Could not write to ' + path)
+        self.frames = 0
+
+    def show(self, frame):
+        self.writer.write(frame)
+        self.frames = self.frames + 1
+        return True
+
+    def close(self):
+        self.writer.release()
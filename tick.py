@@ -0,0 +1,56 @@
+import multiprocessing as mp
+from collections import namedtuple
+from time import time
+
+STEPS_PER_YEAR = 525600
+
+# A single step notification as seen by a consumer
+# index: step index into the dataset
+# timestamp: wall clock time the step was published
+# count: total number of steps published so far
+# missed: steps published since the consumer last looked that it never saw
+Tick = namedtuple('Tick', ['index', 'timestamp', 'count', 'missed'])
+
+class TickBus:
+    def __init__(self, start_index=0):
+        # One condition shared by every process, the raw values are only
+        # touched while holding it so they don't need their own locks
+        self.condition = mp.Condition()
+        self.index = mp.Value('i', start_index, lock=False)
+        self.timestamp = mp.Value('d', time(), lock=False)
+        self.count = mp.Value('q', 0, lock=False)
+
+    @property
+    def value(self):
+        # Unsynchronised read of the current index, for code that polls
+        return self.index.value
+
+    def publish(self, index, timestamp=None):
+        with self.condition:
+            self.index.value = index
+            self.timestamp.value = time() if timestamp is None else timestamp
+            self.count.value = self.count.value + 1
+            self.condition.notify_all()
+
+    def advance(self):
+        # Loop round at end of day
+        self.publish((self.index.value + 1) % STEPS_PER_YEAR)
+
+    def current(self):
+        with self.condition:
+            return Tick(self.index.value, self.timestamp.value, self.count.value, 0)
+
+    def wait(self, count_last=-1, timeout=None):
+        # Block until a step newer than count_last has been published.
+        # Passing -1 returns the current step straight away.
+        # Returns None if the timeout expires first.
+        with self.condition:
+            if count_last >= 0 and self.count.value == count_last:
+                self.condition.wait_for(lambda: self.count.value != count_last, timeout)
+
+            count = self.count.value
+            if count_last >= 0 and count == count_last:
+                return None
+
+            missed = max(count - count_last - 1, 0) if count_last >= 0 else 0
+            return Tick(self.index.value, self.timestamp.value, count, missed)
@@ -0,0 +1,139 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+MINUTES_PER_DAY = 1440
+
+# Bulb colour runs from red (no sun) to green (full sun) in xy space
+RED = 0.7539, 0.2746
+GREEN = 0.0771, 0.8268
+
+# Published timelines live in RAM backed storage where we have it
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Day segments in the order they are coded in the timeline
+SEGMENTS = ['night', 'sunrise', 'midday', 'sunset']
+
+# Final per-minute outputs and the dtype each is stored as
+FIELDS = {
+    'timestamp': np.int64,      # seconds since epoch of the (naive) data time
+    'direct_beam': np.float32,  # normalised direct beam, 0 to 1
+    'color_x': np.float32,      # bulb colour
+    'color_y': np.float32,
+    'brightness': np.uint8,     # bulb brightness
+    'plug_on': np.bool_,        # plug state
+    'ambient_vol': np.uint8,    # return channel volumes
+    'music_vol': np.uint8,
+    'day_segment': np.uint8,    # index into SEGMENTS
+}
+
+class Timeline:
+    def __init__(self, arrays, path=None):
+        self.arrays = arrays
+        self.path = path
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def __reduce__(self):
+        # A published timeline is sent to other processes by name only,
+        # they map the same pages rather than receiving a copy
+        if self.path is not None:
+            return (attach_timeline, (self.path,))
+        return (Timeline, (self.arrays,))
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def color(self, idx):
+        return {'x': round(float(self.color_x[idx]), 4), 'y': round(float(self.color_y[idx]), 4)}
+
+    def plug_state(self, idx):
+        return 'ON' if self.plug_on[idx] else 'OFF'
+
+    def segment(self, idx):
+        return SEGMENTS[self.day_segment[idx]]
+
+    def datetime(self, idx):
+        return datetime.utcfromtimestamp(int(self.timestamp[idx]))
+
+def day_segments(direct_beam):
+    n = len(direct_beam)
+    n_days = -(-n // MINUTES_PER_DAY)
+
+    # Daylight per minute, one row per day
+    daylight = np.zeros(n_days * MINUTES_PER_DAY, dtype=np.bool_)
+    daylight[:n] = direct_beam > 0.5
+    daylight = daylight.reshape(n_days, MINUTES_PER_DAY)
+
+    # Sunrise is the first minute of daylight, sunset the minute after the last.
+    # Days without any daylight keep the old defaults.
+    has_day = daylight.any(axis=1)
+    sunrise = np.where(has_day, daylight.argmax(axis=1), 360)
+    sunset = np.where(has_day, MINUTES_PER_DAY - daylight[:, ::-1].argmax(axis=1), 1080)
+
+    # Calc divisions between time of day
+    segment_length = ((sunset - sunrise) / 4).astype(np.int64)
+    midday_start = (sunrise + segment_length)[:, None]
+    midday_end = (sunset - segment_length)[:, None]
+
+    day_idx = np.arange(MINUTES_PER_DAY)[None, :]
+    segments = np.where(day_idx < 720, SEGMENTS.index('sunrise'), SEGMENTS.index('sunset'))
+    segments = np.where((day_idx > midday_start) & (day_idx < midday_end), SEGMENTS.index('midday'), segments)
+    segments = np.where(daylight, segments, SEGMENTS.index('night'))
+
+    return segments.reshape(-1)[:n].astype(np.uint8)
+
+def build_timeline(df):
+    direct_beam = df['Direct Beam'].to_numpy(dtype=np.float64)
+    brightness = df['Brightness'].to_numpy(dtype=np.float64)
+
+    arrays = {}
+    arrays['timestamp'] = df['Timestamp'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    arrays['direct_beam'] = direct_beam
+
+    arrays['color_x'] = RED[0] - direct_beam * (RED[0] - GREEN[0])
+    arrays['color_y'] = RED[1] - direct_beam * (RED[1] - GREEN[1])
+
+    arrays['brightness'] = np.trunc(126 * brightness + 128)
+    arrays['plug_on'] = direct_beam < 0.25
+
+    arrays['ambient_vol'] = np.trunc(direct_beam * 95)
+    arrays['music_vol'] = 95 - arrays['ambient_vol']
+
+    arrays['day_segment'] = day_segments(direct_beam)
+
+    return Timeline({name: np.ascontiguousarray(arrays[name], dtype=dtype) for name, dtype in FIELDS.items()})
+
+def share_timeline(timeline, name='creatures-timeline'):
+    path = os.path.join(SHARED_DIR, name)
+
+    # Write everything to a scratch directory then swap it in, so nobody
+    # attaches to a half written timeline
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for field, array in timeline.arrays.items():
+        np.save(os.path.join(tmp_path, field + '.npy'), array)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    return attach_timeline(path)
+
+def attach_timeline(path):
+    # Read only views onto the published files, nothing is copied
+    arrays = {}
+    for field in FIELDS:
+        arrays[field] = np.asarray(np.load(os.path.join(path, field + '.npy'), mmap_mode='r'))
+    return Timeline(arrays, path=path)
+
+def unshare_timeline(timeline):
+    if timeline.path is not None:
+        shutil.rmtree(timeline.path, ignore_errors=True)
+
+if __name__ == '__main__':
+    from data import load_data
+    timeline = build_timeline(load_data(cached=True))
+    print(str(len(timeline)) + ' minutes, ' + str(sum(a.nbytes for a in timeline.arrays.values())) + ' bytes')
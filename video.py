@@ -2,17 +2,74 @@ import cv2
 import numpy as np
 import pandas as pd
 from data import load_data, get_start_index
+from timeline import build_timeline
+from effects import WarpMaps, ColourStage, TextOverlay
+from pipeline import FramePipeline, FramePacer, POLL_TIMEOUT, LATE_THRESHOLD
+from library import load_library
+from sinks import WindowSink
+from tick import STEPS_PER_YEAR
+from metrics import histogram, counter
 import multiprocessing as mp
-from time import sleep, time
+import threading
+from time import sleep, perf_counter
 from random import randint, choice
-import os
-from skimage.transform import swirl
-from wrapper import RedisWrapper
+from collections import namedtuple
+
+# Per step inputs to the effects stage, swapped in whole so the effects
+# thread never sees half of one step and half of the next
+FrameSettings = namedtuple('FrameSettings', ['brightness_reduction', 'time_text', 'am_pm_text', 'speed_text', 'padding'])
+
+# Steps ahead of a clip change that the next clip starts loading
+PRELOAD_STEPS = 4
+
+# Wait before trying again when no clip could be opened
+OPEN_RETRY = 1.0
+
+# Tempos shown as Fast and Slow. These were 110 and 90 on the old tempo
+# estimate, which read 16/15 of the real BPM (see pipeline.NORMAL_BPM)
+FAST_BPM = 110 * 15/16
+SLOW_BPM = 90 * 15/16
+
+class Playback:
+    # A clip being played (or got ready to play): its capture, pipeline and
+    # the effects state its effects thread uses. Each has its own so the next
+    # clip can decode and render its first frames alongside the current one.
+    def __init__(self, video, clip, settings):
+        self.clip = clip
+        self.settings = settings
+        self.cap = cv2.VideoCapture(clip.proxy or clip.path)
+        self.fps = int(clip.fps or self.cap.get(cv2.CAP_PROP_FPS))
+        self.num_frames = randint(50,100)
+
+        self.colour = ColourStage(video.width, video.height)
+        self.overlay = TextOverlay(video.load_font(), video.width, video.height)
+
+        # Reused every frame rather than allocating new ones
+        self.resized = np.empty((video.height, video.width, 3), np.uint8)
+        self.coloured = np.empty((video.height, video.width, 3), np.uint8)
+
+        # Decoding and effects run on their own threads, the caller just shows frames
+        self.pacer = FramePacer(self.fps, video.max_fps, metrics=video.metrics)
+        process = lambda frame, n, dst: video.process_frame(self, frame, n, dst)
+        self.pipeline = FramePipeline(self.cap, process, (video.height, video.width, 3), self.pacer, loop_end=clip.loop_end)
+
+    def start(self):
+        self.pipeline.start()
+
+    def stop(self):
+        self.pipeline.stop()
+        self.pipeline.report()
+        self.cap.release()
+
+    def stop_later(self):
+        # Stopping waits on the stage threads, up to POLL_TIMEOUT each, so
+        # anything mid-show is stopped in the background instead
+        threading.Thread(target=self.stop, name='video-stop', daemon=True).start()
 
 class Video:
     # def __init__(self, df, width=1360, height=768, window_name='clock'):
-    def __init__(self, df, use_redis=False, width=800, height=600, window_name='clock'):
-        self.df = df
+    def __init__(self, timeline, use_redis=False, width=800, height=600, window_name='clock', videos=None, metrics=None):
+        self.timeline = timeline
         self.width = width
         self.height = height
         self.background_color = (0,0,0)
@@ -21,17 +78,25 @@ class Video:
         self.max_fps = 40
         self.use_redis = use_redis
 
-        self.videos = self.get_videos()
+        self.videos = videos if videos is not None else self.get_videos()
 
+        # Shared by every clip's effects thread
+        self.warp_maps = WarpMaps()
+
+        self.metrics = metrics
+        self.frame_time = histogram(metrics, 'video.frame_time')
+        self.frames_shown = counter(metrics, 'video.frames_shown')
+        self.frames_late = counter(metrics, 'video.frames_late')
+        self.frames_dropped = counter(metrics, 'video.frames_dropped')
+        self.frames_duplicated = counter(metrics, 'video.frames_duplicated')
+
+        # Only needed for redis, so headless renders don't need the wrapper
         if use_redis:
+            from wrapper import RedisWrapper
             self.r = RedisWrapper()
 
-        # Assume default sunset and sunrise times
-        self.sunrise = 360
-        self.sunset = 1080
-        
-        # Subtract a quarter because it takes a moment to load the video
-        self.music_changes = [x - 1 for x in [720, 1104, 1232, 1360, 48, 176]]
+        # The next clip is preloaded, so it can change right on the music
+        self.music_changes = [720, 1104, 1232, 1360, 48, 176]
 
         self.season_end_dates = [
             {'season': 'autumn', 'date': pd.Timestamp('2022-12-21').date(), 'date_name': 'winter solstice'},
@@ -41,16 +106,9 @@ class Video:
             {'season': 'autumn', 'date': pd.Timestamp('2023-12-21').date(), 'date_name': 'winter solstice'}
         ]
 
-    # Returns a dict of folders : filenames
+    # Returns a dict of folders : Clips, from the library index (python library.py) where there is one
     def get_videos(self, path='videos'):
-        videos = {}
-        for root, dirs, files in os.walk(path):
-            # If the directory has files in it
-            if len(dirs) == 0:
-                # Keep only video files
-                files = [ file for file in files if file.endswith( ('.mp4','.mov') ) ]
-                videos[root] = files
-        return videos
+        return load_library(path)
         
     def change_brightness(self, img, value=30):
         hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
@@ -75,7 +133,7 @@ class Video:
         return image
 
     def get_season(self, i):
-        current_date = self.df.loc[i, "Timestamp"].date()
+        current_date = self.timeline.datetime(i).date()
 
         for season in self.season_end_dates:
             if current_date < season['date']:
@@ -89,253 +147,278 @@ class Video:
         return season['season']
 
     def get_day_segment(self, i):
-            
-            day_idx = i % 1440
-
-            # If it's daytime
-            if self.df.iloc[i]['Direct Beam']  > 0.5:
-                # Calc divisions between time of day
-                segment_length = int((self.sunset - self.sunrise)/4)
-                midday_start = self.sunrise + segment_length
-                midday_end = self.sunset - segment_length
-                # print(str(day_idx))
-                # print('midday start: ' + str(midday_start))
-                # print('midday end: ' + str(midday_end))
-                if day_idx > midday_start and day_idx < midday_end:
-                    day_segment = 'midday'
-                elif day_idx < 720:
-                    day_segment = 'sunrise'
-                else:
-                    day_segment = 'sunset'
-            else:
-                day_segment = 'night'
-
-            # print(day_segment)
-            return day_segment
+        # Segments (and the sunrise/sunset times they depend on) are precomputed
+        return self.timeline.segment(i)
     
-    def warp_image(self, frame, n, num_frames):
-        # get dimensions
-        h, w = frame.shape[:2]
-
-        # set wavelength
-        wave_x = 2*w
-        wave_y = h
-
-        # set amount, number of frames and delay
-        amount_x = 10
-        amount_y = 5
-        border_color = (0,0,0)
-
-        # create X and Y ramps
-        x = np.arange(w, dtype=np.float32)
-        y = np.arange(h, dtype=np.float32)
-        
-        # compute phase to increment over 360 degree for number of frames specified so makes full cycle
-        phase_x = n*360/num_frames
-        phase_y = phase_x
-
-        # create sinusoids in X and Y, add to ramps and tile out to fill to size of image
-        x_sin = amount_x * np.sin(2 * np.pi * (x/wave_x + phase_x/360)) + x
-        map_x = np.tile(x_sin, (h,1))
-
-        y_sin = amount_y * np.sin(2 * np.pi * (y/wave_y + phase_y/360)) + y
-        map_y = np.tile(y_sin, (w,1)).transpose()
-
-        # do the warping using remap and return
-        return cv2.remap(frame.copy(), map_x, map_y, cv2.INTER_CUBIC, borderMode = cv2.BORDER_CONSTANT, borderValue=border_color)
-            
-
-    def run(self, i, bpm):
+    def warp_image(self, frame, n, num_frames, dst=None):
+        # Remap tables come from a per phase cache, frame isn't modified
+        return self.warp_maps.warp(frame, n, num_frames, dst=dst)
+
+    def step_settings(self, index, bpm, day_segment):
+        # Everything the effects stage needs that only changes once a step
+        timestamp = self.timeline.datetime(index)
+        direct_beam = float(self.timeline.direct_beam[index])
+
+        if timestamp.hour in (10,11,12,22,23):
+            padding = 0
+        else:
+            padding = 35
+
+        time_text=timestamp.strftime("%-I:%M")
+        am_pm_text =timestamp.strftime("%p").lower()
+
+        if bpm > FAST_BPM:
+            speed_text = 'Fast'
+        elif bpm < SLOW_BPM:
+            speed_text = 'Slow'
+        else:
+            speed_text = None
+
+        # If it's night
+        if day_segment == 'night':
+            # Inverse of below
+            brightness_reduction = direct_beam * 2 * 255
+        else:
+            # No reduction when brightness is 1 (i.e. midday)
+            # full reduction when brightness is 0.5 (i.e. sunset/sunrise)
+            brightness_reduction = (1 - (direct_beam - 0.5) * 2) * 255
+
+        return FrameSettings(brightness_reduction, time_text, am_pm_text, speed_text, padding)
+
+    def process_frame(self, playback, frame, n, dst):
+        # Runs on the playback's effects thread, renders a decoded frame into dst
+        settings = playback.settings
+
+        # Resize frame, proxies are already the right size
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height), dst=playback.resized)
+
+        # Adjust brightness and switch blues and reds
+        frame = playback.colour.apply(frame, settings.brightness_reduction, dst=playback.coloured)
+
+        # Warp image
+        frame = self.warp_image(frame, n, playback.num_frames, dst=dst)
+
+        # Add in time, am/pm and speed text. Glyphs are only rendered when
+        # the text changes, otherwise it's a blend of the cached masks
+        playback.overlay.set('time', settings.time_text, (100+settings.padding, 300), 150)
+        playback.overlay.set('am_pm', settings.am_pm_text, (500, 300), 150)
+        playback.overlay.set('speed', settings.speed_text, (50, 50), 25)
+        playback.overlay.blend(frame)
+
+    def load_font(self):
+        # Each clip's effects thread gets its own, freetype isn't thread safe
+        ft = cv2.freetype.createFreeType2()
+        ft.loadFontData(fontFileName='Fondamento-Regular.ttf', id=0)
+        return ft
+
+    def next_change(self, index):
+        # The step the clip next has to change on, if it's within PRELOAD_STEPS.
+        # Day segments are precomputed and music changes are fixed, so we know ahead.
+        day_segment = self.get_day_segment(index)
+        for steps in range(1, PRELOAD_STEPS + 1):
+            change_index = (index + steps) % STEPS_PER_YEAR
+            if self.get_day_segment(change_index) != day_segment or change_index % 1440 in self.music_changes:
+                return change_index
+        return None
+
+    def open_clip(self, index, bpm, video=None):
+        # Picks a clip for the step, other than `video`, and gets it going
+        day_segment = self.get_day_segment(index)
+        season = self.get_season(index)
+
+        if day_segment == 'midday':
+            folder = 'videos/midday/' + season
+        else:
+            folder = 'videos/' + day_segment
+
+        # Indexed rather than get() so render.py's defaultdict can fill it in
+        try:
+            clips = self.videos[folder]
+        except KeyError:
+            clips = []
+        if not clips:
+            print('WARNING: No videos to play in ' + folder)
+            return None
+
+        # Anything but the clip we're on, unless it's the only one
+        clip = choice([x for x in clips if x != video] or clips)
+        playback = Playback(self, clip, self.step_settings(index, bpm, day_segment))
+        if not playback.cap.isOpened():
+            print('WARNING: Could not open video ' + clip.path)
+            playback.cap.release()
+            self.forget_clip(clip)
+            return None
+
+        playback.pacer.set_tempo(bpm)
+        playback.start()
+        return playback
+
+    def forget_clip(self, clip):
+        # Left out from now on so it isn't picked again
+        for folder, clips in list(self.videos.items()):
+            if clip in clips:
+                self.videos[folder] = [x for x in clips if x != clip]
+
+    def run(self, i, clock, sink=None, duration=None, paced=True):
+        # Frames go to a fullscreen window unless given another sink (see sinks.py).
+        # Stops when the sink says so, or after `duration` seconds if given.
+        # Unpaced, frames go out as fast as they're made, for measuring throughput.
+        if sink is None:
+            sink = WindowSink(self.window_name)
+        end_time = perf_counter() + duration if duration is not None else None
 
         i_last = -1
         day_segment_last = None
         day_segment = self.get_day_segment(i.value)
         # season, bottom_text = self.get_season(i.value)
         season = self.get_season(i.value)
-        frame_time_last = time()
-        start_time = time()
-        step_time_last = time()
         video = None
-        brightness_reduction = 1
+        playback = None
 
-        ft = cv2.freetype.createFreeType2()
-        ft.loadFontData(fontFileName='Fondamento-Regular.ttf', id=0)
+        # Next clip, preloaded ahead of the step it takes over on
+        upcoming = None
+        upcoming_index = None
+
+        show_last = None
 
         while True:
-            print('loading video')
-
-            if day_segment == 'night':
-                video = choice([x for x in self.videos['videos/night'] if x != video])
-                cap = cv2.VideoCapture('videos/night/' + video)
-            elif day_segment == 'midday':
-                video = choice([x for x in self.videos['videos/midday/' + season] if x != video])
-                cap = cv2.VideoCapture('videos/midday/' + season + '/' + video)
-            else:
-                video = choice([x for x in self.videos['videos/' + day_segment] if x != video])
-                cap = cv2.VideoCapture('videos/' + day_segment + '/' + video)
-
-            fps = int(cap.get(cv2.CAP_PROP_FPS))
-
-            adjusted_fps = fps * bpm.value/100
-
-            n = 0
-            skip_frames = 1
-            num_frames = randint(50,100)
-
-            while cap.isOpened():
-
-                # ret, frame = cap.read()
-                ret = cap.grab()
-
-                if ret == True:
-                    n = n + 1
-                    if n % skip_frames == 0:
-                        
-                        _, frame = cap.retrieve() #decode frame
-
-                        frame_time = time()
-                        actual_fps = 1/(frame_time - frame_time_last)
-                        frame_time_last = frame_time
-
-                        # print('adjusted fps: ' + str(adjusted_fps))
-                        # print('actual fps: ' + str(actual_fps))
-                        # print('skip frames: ' + str(skip_frames))
-                        try:
-                            sleep((1/adjusted_fps) - ((time() - start_time) % (1/adjusted_fps)))
-                        except:
-                            continue
-
-                        if i.value != i_last: # timestep has changed
-                            # print("i = ", i.value)
-                            i_last = i.value
-
-                            adjusted_fps = fps * bpm.value/100
-                            skip_frames = int(adjusted_fps/self.max_fps) + 1
-                            adjusted_fps = adjusted_fps/skip_frames
-
-                            # Get index for hour of day
-                            day_idx = i.value % 1440
-
-                            # Set season and bottom text
-                            # season, bottom_text = self.get_season(i.value)
-
-                            if self.get_season(i.value) != season:
-                                season = self.get_season(i.value)
-
-                            # If day segment has changed, break and start over
-                            if self.get_day_segment(i.value) != day_segment:
-                                day_segment_last = day_segment
-                                day_segment = self.get_day_segment(i.value)
-
-                                if self.use_redis:
-                                    self.r.set('time_day_segment', day_segment)
-                                    self.r.set('time_season', season)
-
-                                print('Day segment has changed from ' + day_segment_last + ' to ' + day_segment)
-                                # Update sunrise and sunset times
-                                if day_segment == 'sunrise' and day_segment_last == 'night':
-                                    self.sunrise = day_idx
-                                elif day_segment == 'night' and day_segment_last == 'sunset':
-                                    self.sunset = day_idx
-                                break
-
-                            # self.r.set('time_bottom_text', bottom_text)
-                            # self.r.set('time_day_idx', day_idx) 
-
-                            # If music has changed break and start over
-                            if day_idx in self.music_changes:
-                                print('Music has changed')
-                                break
-
-                            row = self.df.iloc[i.value]
-
-                            if row['Timestamp'].hour in (10,11,12,22,23):
-                                padding = 0
-                            else:
-                                padding = 35
-
-                            time_text=row['Timestamp'].strftime("%-I:%M")
-                            am_pm_text =row['Timestamp'].strftime("%p").lower()
-
-                            if bpm.value > 110:
-                                speed_text = 'Fast'
-                            elif bpm.value < 90:
-                                speed_text = 'Slow'
-                            else:
-                                speed_text = None
-
-                            # If it's night
-                            if day_segment == 'night':
-                                # Inverse of below
-                                brightness_reduction = row['Direct Beam'] * 2 * 255
-                            else:
-                                # No reduction when brightness is 1 (i.e. midday)
-                                # full reduction when brightness is 0.5 (i.e. sunset/sunrise)
-                                brightness_reduction = (1 - (row['Direct Beam'] - 0.5) * 2) * 255
-                                
-
-                        # Resize frame
-                        frame = cv2.resize(frame, (self.width, self.height))
-
-                        #Adjust brightness
-                        frame = self.change_brightness(frame, value=-brightness_reduction)
-
-                        # Warp image
-                        frame = self.warp_image(frame, n, num_frames)
-                        
-                        # Switch blues and reds
-                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                        # Add in time
-                        ft.putText(img=frame,
-                            text=time_text,
-                            # org=(20+padding, 720),
-                            org=(100+padding, 300),
-                            # fontHeight=75,
-                            fontHeight=150,
-                            color=(255, 255, 255),
-                            thickness=-1,
-                            line_type=cv2.LINE_AA,
-                            bottomLeftOrigin=True)
-                        
-                        # Add in am/pm
-                        ft.putText(img=frame,
-                            text=am_pm_text,
-                            # org=(230, 720),
-                            org=(500, 300),
-                            # fontHeight=75,
-                            fontHeight=150,
-                            color=(255, 255, 255),
-                            thickness=-1,
-                            line_type=cv2.LINE_AA,
-                            bottomLeftOrigin=True)
-                        
-                        # Add in speed text
-                        if speed_text:
-                            ft.putText(img=frame,
-                                text=speed_text,
-                                #org=(1100, 720),
-                                org=(50, 50),
-                                fontHeight=25,
-                                color=(255, 255, 255),
-                                thickness=-1,
-                                line_type=cv2.LINE_AA,
-                                bottomLeftOrigin=True)
-
-                        cv2.imshow(self.window_name, frame)
-                        cv2.namedWindow(self.window_name, cv2.WINDOW_FULLSCREEN)
-                        cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN) #Disable when on large monitor
-                        # cv2.resizeWindow(self.window_name, self.width, self.height) #Enable when on large monitor
-
-                        k = cv2.waitKey(1)
-                        if k==27:    # Esc key to stop
-                            cap.release()
-                            cv2.destroyAllWindows()
-                            return
-                else:
-                    print('returning to start of video')
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if playback is None:
+                print('loading video')
+                playback = self.open_clip(i.value, clock.bpm, video)
+                if playback is None:
+                    sleep(OPEN_RETRY)
+                    continue
+                video = playback.clip
+
+            if i.value != i_last: # timestep has changed
+                # print("i = ", i.value)
+                i_last = i.value
+
+                bpm = clock.bpm
+
+                # Get index for hour of day
+                day_idx = i.value % 1440
+
+                # Set season and bottom text
+                # season, bottom_text = self.get_season(i.value)
+
+                if self.get_season(i.value) != season:
+                    season = self.get_season(i.value)
+
+                change = False
 
+                # If day segment has changed, start over
+                if self.get_day_segment(i.value) != day_segment:
+                    day_segment_last = day_segment
+                    day_segment = self.get_day_segment(i.value)
+
+                    if self.use_redis:
+                        self.r.set('time_day_segment', day_segment)
+                        self.r.set('time_season', season)
+
+                    print('Day segment has changed from ' + day_segment_last + ' to ' + day_segment)
+                    change = True
+
+                # self.r.set('time_bottom_text', bottom_text)
+                # self.r.set('time_day_idx', day_idx)
+
+                # If music has changed start over
+                if day_idx in self.music_changes:
+                    print('Music has changed')
+                    change = True
+
+                if upcoming is not None and upcoming_index == i.value:
+                    # Its first frames are already decoded and rendered
+                    playback.stop_later()
+                    playback = upcoming
+                    video = playback.clip
+                    upcoming = None
+                else:
+                    if upcoming is not None and (upcoming_index - i.value) % STEPS_PER_YEAR > PRELOAD_STEPS:
+                        # Steps were skipped and we missed it
+                        upcoming.stop_later()
+                        upcoming = None
+
+                    if change:
+                        # Nothing ready, load the next clip here
+                        playback.stop_later()
+                        playback = None
+                        if upcoming is not None:
+                            upcoming.stop_later()
+                            upcoming = None
+                        continue
+
+                # Picked up by the effects thread from its next frame
+                playback.settings = self.step_settings(i.value, bpm, day_segment)
+
+                # Get the next clip going in the background ahead of a change
+                if upcoming is None:
+                    upcoming_index = self.next_change(i.value)
+                    if upcoming_index is not None:
+                        upcoming = self.open_clip(upcoming_index, bpm, video)
+
+            # Tempo is followed frame by frame, not just when the step changes
+            pacer = playback.pacer
+            pacer.set_tempo(clock.bpm)
+
+            wait_start = perf_counter()
+            try:
+                item = playback.pipeline.get(POLL_TIMEOUT)
+            except Exception:
+                # Its decoding or effects failed, so play something else
+                print('WARNING: Could not play video ' + playback.clip.path)
+                self.forget_clip(playback.clip)
+                playback.stop_later()
+                playback = None
+                continue
+            if item is None:
+                continue
+            slot, position, frame = item
+
+            if paced:
+                # A new clip's timeline starts from its first frame shown
+                if not pacer.started:
+                    pacer.start(position)
+
+                deadline = pacer.deadline(position)
+                lateness = perf_counter() - deadline
+                if lateness > pacer.interval():
+                    # It wasn't ready in time, so the last frame was shown twice
+                    pacer.add_duplicated()
+                    self.frames_duplicated.add()
+                    if playback.pipeline.waiting():
+                        # Too late to be worth showing and the next is ready
+                        pacer.add_dropped()
+                        self.frames_dropped.add()
+                        playback.pipeline.release(slot)
+                        continue
+                elif lateness < 0:
+                    sleep(-lateness)
+            else:
+                deadline = perf_counter()
+
+            show_start = perf_counter()
+            keep_going = sink.show(frame)
+
+            pacer.shown = pacer.shown + 1
+            self.frames_shown.add()
+            if show_start - deadline > LATE_THRESHOLD:
+                pacer.late = pacer.late + 1
+                self.frames_late.add()
+            if show_last is not None:
+                self.frame_time.observe(show_start - show_last)
+            show_last = show_start
+
+            playback.pipeline.release(slot)
+            playback.pipeline.stats['display'].add(perf_counter() - show_start, show_start - wait_start)
+
+            if not keep_going or (end_time is not None and perf_counter() > end_time):
+                playback.stop()
+                if upcoming is not None:
+                    upcoming.stop()
+                sink.close()
+                return
 
 if __name__ == "__main__":
     df = load_data(cached=True)
@@ -343,5 +426,5 @@ if __name__ == "__main__":
     j = mp.Value('i', 0)
     element = mp.Value('i', 0)
 
-    my_video = Video(df)
+    my_video = Video(build_timeline(df))
     # my_video.run(i, j)
\ No newline at end of file
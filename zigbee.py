@@ -0,0 +1,54 @@
+import json
+from urllib.parse import urlparse
+
+BASE_TOPIC = 'zigbee2mqtt'
+
+class PlatypushBackend:
+    # Original path through platypush, kept as a fallback
+    def send(self, name, payload):
+        from platypush.context import get_plugin
+        get_plugin('zigbee.mqtt').publish(topic=BASE_TOPIC + '/' + name + '/set', msg=payload)
+
+    def close(self):
+        return
+
+class MqttBackend:
+    # Publishes straight to zigbee2mqtt over one persistent connection
+    def __init__(self, url_str='mqtt://localhost:1883', client=None):
+        if client is None:
+            import paho.mqtt.client as mosquitto
+            client = mosquitto.Client()
+        self.client = client
+        self.topics = {}
+
+        url = urlparse(url_str)
+        self.client.username_pw_set(url.username, url.password)
+        self.client.connect(url.hostname, url.port)
+
+        # Network loop runs in paho's own thread, publish just queues
+        self.client.loop_start()
+
+    def topic(self, name):
+        if name not in self.topics:
+            self.topics[name] = BASE_TOPIC + '/' + name + '/set'
+        return self.topics[name]
+
+    def send(self, name, payload):
+        if not isinstance(payload, (bytes, str)):
+            payload = json.dumps(payload, separators=(',', ':'))
+
+        info = self.client.publish(self.topic(name), payload, qos=0)
+        if info.rc != 0:
+            raise ConnectionError('MQTT publish to ' + name + ' failed (rc ' + str(info.rc) + ')')
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+def get_backend(name='mqtt', **kwargs):
+    if name == 'mqtt':
+        return MqttBackend(**kwargs)
+    elif name == 'platypush':
+        return PlatypushBackend()
+    else:
+        raise Exception("Backend not recognized")